@@ -0,0 +1,215 @@
+"""
+Registry of AES-128 backends used for symmetric encryption.
+
+Every backend uses the same scheme as class_based_aes (ECB with each block
+padded as in Encrypt.padding) so cipher text is interchangeable with existing
+clients and stored databases.
+
+An accelerated backend is picked when one can be imported, falling back to
+the pure python class_based_aes. Set the NEAT_AES_BACKEND environment
+variable to a backend name to override the choice.
+"""
+import os
+import threading
+
+import class_based_aes as aes
+
+
+BACKEND_ENV_VAR = 'NEAT_AES_BACKEND'
+
+# FIPS-197 appendix C.1
+KAT_KEY = bytes(range(16))
+KAT_PLAIN_TEXT = bytes.fromhex('00112233445566778899aabbccddeeff')
+KAT_CIPHER_TEXT = bytes.fromhex('69c4e0d86a7b0430d8cdb78070b4c55a')
+
+# covers empty data, partial blocks and exact multiples of the block size
+SELF_TEST_LENGTHS = (0, 1, 15, 16, 17, 31, 32, 33, 100, 1000)
+
+
+class BackendUnavailableError(Exception):
+    pass
+
+
+class BackendConformanceError(Exception):
+    pass
+
+
+class PurePythonBackend(aes.Encrypt, aes.Decrypt):
+    """The reference backend - always available"""
+    name = 'class_based_aes'
+
+
+class CryptographyBackend():
+    """AES from the cryptography package (OpenSSL)"""
+    name = 'cryptography'
+
+    def __init__(self):
+        try:
+            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+            from cryptography.hazmat.primitives import padding
+        except ImportError as e:
+            raise BackendUnavailableError(
+                "cryptography is not installed") from e
+        self.Cipher = Cipher
+        self.algorithms = algorithms
+        self.modes = modes
+        self.padding = padding
+
+    def encrypt(self, plain_text: bytes, key: bytes) -> bytes:
+        padder = self.padding.PKCS7(128).padder()
+        padded_plain_text = padder.update(plain_text) + padder.finalize()
+        encryptor = self.Cipher(self.algorithms.AES(
+            key), self.modes.ECB()).encryptor()
+        return encryptor.update(padded_plain_text) + encryptor.finalize()
+
+    def decrypt(self, cipher_text: bytes, key: bytes) -> bytes:
+        decryptor = self.Cipher(self.algorithms.AES(
+            key), self.modes.ECB()).decryptor()
+        padded_plain_text = decryptor.update(cipher_text) + decryptor.finalize()
+        unpadder = self.padding.PKCS7(128).unpadder()
+        return unpadder.update(padded_plain_text) + unpadder.finalize()
+
+    def decrypt_batch(self, items: list) -> list:
+        return [self.decrypt(cipher_text, key) for cipher_text, key in items]
+
+
+class PycryptodomeBackend():
+    """AES from pycryptodome (installed as either Crypto or Cryptodome)"""
+    name = 'pycryptodome'
+
+    def __init__(self):
+        try:
+            from Crypto.Cipher import AES
+            from Crypto.Util.Padding import pad, unpad
+        except ImportError:
+            try:
+                from Cryptodome.Cipher import AES
+                from Cryptodome.Util.Padding import pad, unpad
+            except ImportError as e:
+                raise BackendUnavailableError(
+                    "pycryptodome is not installed") from e
+        self.AES = AES
+        self.pad = pad
+        self.unpad = unpad
+
+    def encrypt(self, plain_text: bytes, key: bytes) -> bytes:
+        return self.AES.new(key, self.AES.MODE_ECB).encrypt(self.pad(plain_text, 16))
+
+    def decrypt(self, cipher_text: bytes, key: bytes) -> bytes:
+        return self.unpad(self.AES.new(key, self.AES.MODE_ECB).decrypt(cipher_text), 16)
+
+    def decrypt_batch(self, items: list) -> list:
+        return [self.decrypt(cipher_text, key) for cipher_text, key in items]
+
+
+# name -> backend class, in order of preference
+BACKENDS = {}
+
+_backends = {}  # name -> backend instance that passed the conformance test
+_default_backend = None
+_lock = threading.Lock()
+
+
+def register_backend(name: str, backend_class, prefer: bool = False):
+    """
+    Adds a backend to the registry.
+
+    backend_class is called with no arguments and should raise
+    BackendUnavailableError if it can't be used. Set prefer to try it before
+    the already registered backends
+    """
+    global BACKENDS
+    if prefer:
+        BACKENDS = {name: backend_class, **BACKENDS}
+    else:
+        BACKENDS[name] = backend_class
+
+
+def conformance_failures(backend, reference=None) -> list:
+    """
+    Checks backend against the FIPS-197 vector and the reference backend for
+    every length in SELF_TEST_LENGTHS
+
+    Returns a list of failures (empty if the backend conforms)
+    """
+    if reference is None:
+        reference = PurePythonBackend()
+    failures = []
+    try:
+        if backend.encrypt(KAT_PLAIN_TEXT, KAT_KEY)[:16] != KAT_CIPHER_TEXT:
+            failures.append('FIPS-197 known answer')
+        for key_number in range(3):
+            key = bytes((key_number * 31 + i * 17) % 256 for i in range(16))
+            for length in SELF_TEST_LENGTHS:
+                plain_text = bytes((i * 7 + length) % 256 for i in range(length))
+                cipher_text = backend.encrypt(plain_text, key)
+                if cipher_text != reference.encrypt(plain_text, key):
+                    failures.append(f'encrypt {length} bytes with key {key_number}')
+                elif backend.decrypt(cipher_text, key) != plain_text:
+                    failures.append(f'decrypt {length} bytes with key {key_number}')
+    except Exception as e:
+        failures.append(f'raised {e!r}')
+    return failures
+
+
+def available_backends() -> list:
+    """Returns the names of the registered backends that can be imported"""
+    names = []
+    for name, backend_class in BACKENDS.items():
+        try:
+            backend_class()
+            names.append(name)
+        except BackendUnavailableError:
+            pass
+    return names
+
+
+def load_backend(name: str):
+    """
+    Returns an instance of the named backend after checking it conforms.
+
+    Raises BackendUnavailableError or BackendConformanceError if it can't be used
+    """
+    with _lock:
+        if name in _backends:
+            return _backends[name]
+    if name not in BACKENDS:
+        raise BackendUnavailableError(f"No AES backend called {name!r}")
+    backend = BACKENDS[name]()
+    failures = conformance_failures(backend)
+    if failures:
+        raise BackendConformanceError(
+            f"AES backend {name!r} failed: {', '.join(failures)}")
+    with _lock:
+        _backends[name] = backend
+    return backend
+
+
+def get_backend(name: str = None):
+    """
+    Returns the backend to use for encryption.
+
+    If name is not given NEAT_AES_BACKEND is used, and if that is not set the
+    first registered backend that is available and conforms is used
+    """
+    global _default_backend
+    if name is None:
+        name = os.environ.get(BACKEND_ENV_VAR) or None
+    if name is not None:
+        return load_backend(name)
+
+    if _default_backend is None:
+        for backend_name in list(BACKENDS):
+            try:
+                _default_backend = load_backend(backend_name)
+                break
+            except BackendUnavailableError:
+                continue
+            except BackendConformanceError as e:
+                print(f"[AES BACKEND SKIPPED] {e}")
+    return _default_backend
+
+
+register_backend(CryptographyBackend.name, CryptographyBackend)
+register_backend(PycryptodomeBackend.name, PycryptodomeBackend)
+register_backend(PurePythonBackend.name, PurePythonBackend)
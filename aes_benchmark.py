@@ -0,0 +1,226 @@
+"""
+Benchmarks and known answer tests for the AES backends in aes_backends.
+
+Checks every backend against the FIPS-197 and SP 800-38A vectors before
+timing encrypt, decrypt and key expansion for each payload size.
+
+    python aes_benchmark.py
+    python aes_benchmark.py --backend class_based_aes --output results.json
+    python aes_benchmark.py --baseline results.json --tolerance 0.1
+
+Exits with 1 if a known answer test fails or a result is more than
+tolerance slower than the baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import aes_backends
+import class_based_aes as aes
+
+
+# 16 bytes up to a multi-megabyte image
+PAYLOAD_SIZES = (16, 1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+MIN_TIME = 0.5  # seconds each measurement is repeated for
+TOLERANCE = 0.1  # fraction slower than the baseline counted as a regression
+
+# FIPS-197 appendix C.1 - (key, plain text, cipher text)
+FIPS_197_VECTOR = (
+    '000102030405060708090a0b0c0d0e0f',
+    '00112233445566778899aabbccddeeff',
+    '69c4e0d86a7b0430d8cdb78070b4c55a',
+)
+
+# FIPS-197 appendix A.1 - (key, last round key)
+FIPS_197_KEY_EXPANSION_VECTOR = (
+    '2b7e151628aed2a6abf7158809cf4f3c',
+    'd014f9a8c9ee2589e13f0cc8b6630ca6',
+)
+
+# SP 800-38A F.1.1 ECB-AES128 - (key, plain text, cipher text)
+SP_800_38A_ECB_VECTOR = (
+    '2b7e151628aed2a6abf7158809cf4f3c',
+    '6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'
+    '30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710',
+    '3ad77bb40d7a3660a89ecaf32466ef97f5d3d58503b9699de785895a96fdbaaf'
+    '43b1cd7f598ece23881b00e3ed0306887b0c785e27e8ad3f8223207104725dd4',
+)
+
+# SP 800-38A F.5.1 CTR-AES128 - (key, initial counter, plain text, cipher text)
+SP_800_38A_CTR_VECTOR = (
+    '2b7e151628aed2a6abf7158809cf4f3c',
+    'f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff',
+    '6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'
+    '30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710',
+    '874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff'
+    '5ae4df3edbd5d35e5b4f09020db03eab1e031dda2fbe03d1792170a0f3009cee',
+)
+
+
+def known_answer_failures(backend) -> list:
+    """Returns the names of the known answer tests backend fails (empty if it passes them all)"""
+    failures = []
+    for name, (key, plain_text, cipher_text) in (('FIPS-197 C.1', FIPS_197_VECTOR),
+                                                 ('SP 800-38A F.1.1', SP_800_38A_ECB_VECTOR)):
+        key, plain_text, cipher_text = bytes.fromhex(
+            key), bytes.fromhex(plain_text), bytes.fromhex(cipher_text)
+        # the last block of the output is the padding block
+        output = backend.encrypt(plain_text, key)
+        if output[:len(cipher_text)] != cipher_text:
+            failures.append(f'{name} encrypt')
+        elif backend.decrypt(cipher_text + output[len(cipher_text):], key) != plain_text:
+            failures.append(f'{name} decrypt')
+
+    # the parts only class_based_aes has
+    if isinstance(backend, aes.Encrypt):
+        key, last_round_key = FIPS_197_KEY_EXPANSION_VECTOR
+        round_keys = aes.keyExpansion().round_key_words(bytes.fromhex(key))
+        if aes.BLOCK.pack(*round_keys[40:44]) != bytes.fromhex(last_round_key):
+            failures.append('FIPS-197 A.1 key expansion')
+
+        key, initial_counter, plain_text, cipher_text = (
+            bytes.fromhex(value) for value in SP_800_38A_CTR_VECTOR)
+        counter_mode = aes.CounterMode(max_workers=1)
+        if counter_mode.encrypt(plain_text, key, initial_counter) != cipher_text:
+            failures.append('SP 800-38A F.5.1 CTR')
+
+        key, plain_text, cipher_text = (bytes.fromhex(value)
+                                        for value in FIPS_197_VECTOR)
+        padded_cipher_text = cipher_text + backend.encrypt(plain_text, key)[16:]
+        if aes.Decrypt().decrypt_batch([(padded_cipher_text, key)] * 3) != [plain_text] * 3:
+            failures.append('FIPS-197 C.1 batch decrypt')
+    return failures
+
+
+def time_operation(operation, min_time: float) -> float:
+    """Returns the average number of seconds operation takes, repeating it for at least min_time"""
+    repeats = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time or repeats == 0:
+        operation()
+        repeats += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / repeats
+
+
+def benchmark_backend(backend, sizes=PAYLOAD_SIZES, min_time: float = MIN_TIME) -> dict:
+    """
+    Times encrypt and decrypt for every payload size (and key expansion for class_based_aes)
+
+    Returns {operation: {size: {'mb_per_s': x, 'blocks_per_s': x}}}
+    """
+    key = os.urandom(16)
+    results = {'encrypt': {}, 'decrypt': {}}
+    for size in sizes:
+        plain_text = os.urandom(size)
+        cipher_text = backend.encrypt(plain_text, key)
+        blocks = len(cipher_text) // 16
+        for operation, function, data in (('encrypt', backend.encrypt, plain_text),
+                                          ('decrypt', backend.decrypt, cipher_text)):
+            seconds = time_operation(lambda: function(data, key), min_time)
+            results[operation][str(size)] = {
+                'mb_per_s': size / seconds / 1_000_000,
+                'blocks_per_s': blocks / seconds,
+            }
+
+    if isinstance(backend, aes.Encrypt):
+        # straight to the key schedule so KEY_SCHEDULE_CACHE is not timed
+        key_expansion = aes.keyExpansion()
+        seconds = time_operation(
+            lambda: key_expansion.round_key_words(key), min_time)
+        results['key_expansion'] = {'keys_per_s': 1 / seconds}
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    """Returns a description of every result more than tolerance slower than the same result in baseline"""
+    regressions = []
+    for backend_name, operations in results['backends'].items():
+        baseline_operations = baseline.get('backends', {}).get(backend_name, {})
+        for operation, measurements in operations.items():
+            baseline_measurements = baseline_operations.get(operation, {})
+            if operation == 'key_expansion':
+                # one measurement rather than one per size
+                measurements = {'all': measurements}
+                baseline_measurements = {'all': baseline_measurements}
+            for size, values in measurements.items():
+                for unit in ('mb_per_s', 'keys_per_s'):
+                    old_value = baseline_measurements.get(size, {}).get(unit)
+                    if unit not in values or not old_value:
+                        continue
+                    if values[unit] < old_value * (1 - tolerance):
+                        regressions.append(
+                            f"{backend_name} {operation} {size} {unit}: {values[unit]:.3f} (baseline {old_value:.3f})")
+    return regressions
+
+
+def run(backend_names: list, sizes=PAYLOAD_SIZES, min_time: float = MIN_TIME) -> tuple:
+    """Runs the known answer tests and benchmarks returning (results, known_answer_failures)"""
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'backends': {},
+    }
+    failures = {}
+    for name in backend_names:
+        backend = aes_backends.BACKENDS[name]()
+        print(f"[KNOWN ANSWER TESTS] {name}")
+        backend_failures = known_answer_failures(backend)
+        if backend_failures:
+            # no point timing a backend that gives the wrong answer
+            failures[name] = backend_failures
+            print(f"[FAILED] {', '.join(backend_failures)}")
+            continue
+        print(f"[BENCHMARKING] {name}")
+        results['backends'][name] = benchmark_backend(backend, sizes, min_time)
+        for operation in ('encrypt', 'decrypt'):
+            for size, values in results['backends'][name][operation].items():
+                print(
+                    f"    {operation:<8}{size:>10} bytes {values['mb_per_s']:>10.3f} MB/s {values['blocks_per_s']:>14.0f} blocks/s")
+        if 'key_expansion' in results['backends'][name]:
+            print(
+                f"    key expansion {results['backends'][name]['key_expansion']['keys_per_s']:.0f} keys/s")
+    return results, failures
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="AES known answer tests and benchmarks")
+    parser.add_argument('--backend', action='append',
+                        help="backend to test (can be repeated, defaults to every available backend)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=PAYLOAD_SIZES,
+                        help="payload sizes in bytes")
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+                        help="seconds to repeat each measurement for")
+    parser.add_argument('--output', help="file to save the results to as JSON")
+    parser.add_argument('--baseline', help="JSON results to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="fraction slower than the baseline counted as a regression")
+    args = parser.parse_args(argv)
+
+    backend_names = args.backend or aes_backends.available_backends()
+    results, failures = run(backend_names, args.sizes, args.min_time)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+        print(f"[RESULTS SAVED] {args.output}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(
+                results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"[REGRESSION] {regression}")
+
+    return 1 if failures or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
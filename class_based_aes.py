@@ -4,7 +4,23 @@ An OOP approach to AES in python.
 If you are using OOP you can inherit from aes.Encrypt and aes.Decrypt 
 
 Otherwise create instances of each class and use .encrypt() and .decrypt()
+
+Blocks are encrypted with a table driven engine: SubBytes, ShiftRows and 
+MixColumns are merged into four 32 bit lookup tables per direction and the 
+state is kept as four column words. The step by step functions in 
+SharedFunctions are kept as the reference implementation.
 """
+import io
+import os
+import struct
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional - decrypt_batch falls back to pure python without it
+    np = None
 
 
 # CONSTANTS
@@ -41,36 +57,140 @@ INV_MATRIX = [[0x0e, 0x0b, 0x0d, 0x09], [0x09, 0x0e, 0x0b, 0x0d],
 
 ENCODING = 'utf-8'
 
+CHUNK_SIZE = 64 * 1024  # bytes read at a time by the file wrappers
+
+BLOCK = struct.Struct('>4I')  # one 16 byte block as four big endian column words
+COUNTER_BLOCK = struct.Struct('>QQ')  # 128 bit counter split into two halves for packing
+
+# magic, version, initial counter block
+ATTACHMENT_HEADER = struct.Struct('>4sB16s')
+ATTACHMENT_MAGIC = b'NEAC'
+ATTACHMENT_VERSION = 1
+
+# payloads smaller than this are encrypted in process as starting workers costs more than it saves
+PARALLEL_THRESHOLD = 256 * 1024
+
+
+def _gf_mult(a: int, b: int) -> int:
+    """multiplication in gaussian feild 2^8 (only used to build the lookup tables at import)"""
+    result = 0
+    for i in range(8):
+        if b & 1:
+            result ^= a
+        sgt255 = a & 0x80
+        a = (a << 1) & 0xff
+        if sgt255:
+            a ^= 0x1b
+        b >>= 1
+    return result
+
+
+# products for every coefficient in MATRIX and INV_MATRIX, indexed as GF_MULT_TABLES[coefficient][byte]
+MUL2 = tuple(_gf_mult(x, 0x02) for x in range(256))
+MUL3 = tuple(_gf_mult(x, 0x03) for x in range(256))
+MUL9 = tuple(_gf_mult(x, 0x09) for x in range(256))
+MUL11 = tuple(_gf_mult(x, 0x0b) for x in range(256))
+MUL13 = tuple(_gf_mult(x, 0x0d) for x in range(256))
+MUL14 = tuple(_gf_mult(x, 0x0e) for x in range(256))
+GF_MULT_TABLES = {0x01: tuple(range(256)), 0x02: MUL2, 0x03: MUL3,
+                  0x09: MUL9, 0x0b: MUL11, 0x0d: MUL13, 0x0e: MUL14}
+
+
+def _ror8(word: int) -> int:
+    """rotates a 32 bit word right by one byte"""
+    return ((word >> 8) | (word << 24)) & 0xffffffff
+
+
+def _build_round_tables(sub_box, coefficients):
+    """
+    Builds the four lookup tables for one direction of the cipher
+
+    Table 0 maps a byte in row 0 to its substituted value multiplied by the
+    column of coefficients. Tables 1-3 are the same word rotated for rows 1-3
+    """
+    table_0 = []
+    for x in range(256):
+        s = sub_box[x]
+        word = 0
+        for coefficient in coefficients:
+            word = (word << 8) | GF_MULT_TABLES[coefficient][s]
+        table_0.append(word)
+    table_1 = [_ror8(word) for word in table_0]
+    table_2 = [_ror8(word) for word in table_1]
+    table_3 = [_ror8(word) for word in table_2]
+    return tuple(table_0), tuple(table_1), tuple(table_2), tuple(table_3)
+
+
+# first column of MATRIX and INV_MATRIX read top to bottom
+TE0, TE1, TE2, TE3 = _build_round_tables(S_BOX, (0x2, 0x1, 0x1, 0x3))
+TD0, TD1, TD2, TD3 = _build_round_tables(INVERSE_S_BOX, (0x0e, 0x09, 0x0d, 0x0b))
+
+NUMPY_AVAILABLE = np is not None
+if NUMPY_AVAILABLE:
+    NP_TD0, NP_TD1, NP_TD2, NP_TD3, NP_INVERSE_S_BOX = (
+        np.array(table, dtype=np.uint32) for table in (TD0, TD1, TD2, TD3, INVERSE_S_BOX))
+
 
 class keyExpansion():
 
     def key_expansion(self, key: bytes):
-        key_schedule = []
-        # key = key.encode(encoding)
-        key = self.bytes_to_matrix(key)
-        # Adding first round key
-        key_schedule.append(key)
+        """Returns the 11 round keys as 4x4 matrices (list of columns). Wrapper around round_key_words"""
+        words = self.round_key_words(key)
+        return [self.words_to_matrix(words[i:i+4]) for i in range(0, 44, 4)]
+
+    def round_key_words(self, key: bytes) -> tuple:
+        """Returns the 44 round key words (11 round keys of 4 columns) used by the table driven engine"""
+        if len(key) != 16:
+            raise ValueError("Key must be 16 bytes")
+        words = list(BLOCK.unpack(bytes(key)))
         # key expansion 10 rounds for 128 bit key
         for current_round in range(10):
-            round_key = []
-            # taking last column and applying set of opperations to it
-            final_column = key_schedule[current_round][3]
-            transformed_column = self.round_constant(
-                self.sub_word(self.rot_word(final_column), True), current_round)
-            # using transformed_column to create next round key by xoring with previous round keys
+            # rot word, sub word and round constant on the last column in one go
+            column = words[-1]
+            column = (S_BOX[(column >> 16) & 0xff] << 24 | S_BOX[(column >> 8) & 0xff] << 16 |
+                      S_BOX[column & 0xff] << 8 | S_BOX[column >> 24]) ^ (CONSTANT_COLUMN[current_round] << 24)
+            # each new column is xored with the same column from the previous round key
             for i in range(4):
-                transformed_column = self.xor(
-                    transformed_column, key_schedule[current_round][i])
-                # copies value in list rather than list itself
-                xor_column = transformed_column[:]
-                round_key.append(xor_column)
-            key_schedule.append(round_key)
-        return key_schedule
+                column ^= words[-4]
+                words.append(column)
+        return tuple(words)
+
+    def inverse_round_key_words(self, round_keys: tuple) -> tuple:
+        """
+        Returns the round keys for the equivalent inverse cipher
+
+        Keys are in the order they are used when decrypting with the middle 
+        round keys passed through InvMixColumns
+        """
+        inverse_keys = list(round_keys[40:44])
+        for round in range(9, 0, -1):
+            for word in round_keys[4*round:4*round+4]:
+                # TD tables include the inverse s box so sub the bytes first to cancel it out
+                inverse_keys.append(TD0[S_BOX[word >> 24]] ^ TD1[S_BOX[(word >> 16) & 0xff]] ^
+                                    TD2[S_BOX[(word >> 8) & 0xff]] ^ TD3[S_BOX[word & 0xff]])
+        inverse_keys.extend(round_keys[0:4])
+        return tuple(inverse_keys)
 
     def bytes_to_matrix(self, key: bytes) -> list:
         """converts 16 bytes into a 4x4 matrix"""
         return [list(key[j:j+4]) for j in range(0, 16, 4)]
 
+    def bytes_to_words(self, block: bytes) -> tuple:
+        """converts 16 bytes into 4 column words"""
+        return BLOCK.unpack(bytes(block))
+
+    def words_to_bytes(self, words) -> bytes:
+        """converts 4 column words into 16 bytes"""
+        return BLOCK.pack(*words)
+
+    def words_to_matrix(self, words) -> list:
+        """converts 4 column words into a 4x4 matrix so they can be used with the step by step functions"""
+        return self.bytes_to_matrix(self.words_to_bytes(words))
+
+    def matrix_to_words(self, matrix: list) -> tuple:
+        """converts a 4x4 matrix into 4 column words"""
+        return self.bytes_to_words(bytes(sum(matrix, [])))
+
     def rot_word(self, column):
         """Shifts all items in list forward one with the front most item moving to the back"""
         return column[1:] + [column[0]]
@@ -97,6 +217,74 @@ class keyExpansion():
         return a
 
 
+class KeyScheduleCache(keyExpansion):
+    """
+    Bounded, thread safe cache of expanded round keys keyed by the key bytes.
+
+    Least recently used keys are evicted once max_size keys are stored. 
+    Long lived keys (master_key, password_hash) then only get expanded once 
+    rather than on every encrypt/decrypt call
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__schedules = OrderedDict()  # key bytes -> [round_keys, inverse_keys or None]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__schedules)
+
+    def encryption_keys(self, key: bytes) -> tuple:
+        """Returns the round key words for key expanding and storing them if they are not cached"""
+        return self.__get_schedule(bytes(key))[0]
+
+    def decryption_keys(self, key: bytes) -> tuple:
+        """Returns the inverse round key words for key expanding and storing them if they are not cached"""
+        key = bytes(key)
+        schedule = self.__get_schedule(key)
+        if schedule[1] is None:
+            # only worked out the first time a key is used to decrypt
+            schedule[1] = self.inverse_round_key_words(schedule[0])
+        return schedule[1]
+
+    def __get_schedule(self, key: bytes) -> list:
+        with self.__lock:
+            schedule = self.__schedules.get(key)
+            if schedule is not None:
+                self.__schedules.move_to_end(key)
+                self.hits += 1
+                return schedule
+            self.misses += 1
+
+        # expanding outside the lock so other threads are not held up
+        schedule = [self.round_key_words(key), None]
+        with self.__lock:
+            self.__schedules[key] = schedule
+            self.__schedules.move_to_end(key)
+            while len(self.__schedules) > self.max_size:
+                self.__schedules.popitem(last=False)
+        return schedule
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters along with the current and max size"""
+        with self.__lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self.__schedules), 'max_size': self.max_size}
+
+    def clear(self):
+        """Removes all cached key schedules and resets the counters"""
+        with self.__lock:
+            self.__schedules.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# shared by every Encrypt/Decrypt instance
+KEY_SCHEDULE_CACHE = KeyScheduleCache()
+
+
 class SharedFunctions(keyExpansion):
     def sub_bytes(self, block, encrypt: bool):
         """
@@ -115,19 +303,9 @@ class SharedFunctions(keyExpansion):
 
     def gf_mult(self, a: int, b: int) -> int:
         """multiplication in gaussian feild 2^8"""
-        if b == 1:
-            result = a
-        else:
-            result = 0
-            for i in range(8):
-                if (b & 1):  # if lsb = 1 xor with a
-                    result ^= a
-                sgt255 = a & 0x80
-                a <<= 1  # shift a left
-                if sgt255:  # modulo
-                    a ^= 0x11b
-                b >>= 1  # shift b down
-        return result
+        if b in GF_MULT_TABLES:
+            return GF_MULT_TABLES[b][a]
+        return _gf_mult(a, b)
 
     def mix_columns(self, block, encrypt: bool):
         """
@@ -135,20 +313,17 @@ class SharedFunctions(keyExpansion):
         Parameters:
         - encrypt (bool): If encrypting set True // If decrypting set False
         """
-        mixed_columns = [[0, 0, 0, 0], [
-            0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
         if encrypt == True:
-            for i in range(4):
-                for j in range(4):
-                    for k in range(4):
-                        mixed_columns[i][j] ^= self.gf_mult(
-                            block[i][k], MATRIX[j][k])
+            matrix = MATRIX
         else:
-            for i in range(4):
-                for j in range(4):
-                    for k in range(4):
-                        mixed_columns[i][j] ^= self.gf_mult(
-                            block[i][k], INV_MATRIX[j][k])
+            matrix = INV_MATRIX
+        # looking up the table for each coefficient once per call rather than per byte
+        rows = [[GF_MULT_TABLES[coefficient] for coefficient in row]
+                for row in matrix]
+        mixed_columns = []
+        for column in block:
+            mixed_columns.append([row[0][column[0]] ^ row[1][column[1]] ^ row[2][column[2]] ^ row[3][column[3]]
+                                  for row in rows])
         return mixed_columns
 
     def xor_key(self, block, round: int, key_schedule: list):
@@ -159,39 +334,74 @@ class SharedFunctions(keyExpansion):
 class Encrypt(SharedFunctions):
 
     def encrypt(self, plain_text: bytes, key: bytes) -> bytes:
-        cipher_text = []
-        key_schedule = self.key_expansion(key)
-        # formatting data
-        # plain_text = plain_text.encode(ENCODING)
-        padded_plain_text = self.padding(plain_text)
+        cipher_text = bytearray(self.encrypted_length(len(plain_text)))
+        self.encrypt_into(plain_text, key, cipher_text)
+        return bytes(cipher_text)
+
+    def encrypt_into(self, plain_text: bytes, key: bytes, out) -> int:
+        """
+        Encrypts plain_text straight into a caller supplied buffer
+
+        Parameters:
+        - out (bytearray/memoryview): must be at least encrypted_length(len(plain_text)) bytes
+
+        Returns the number of bytes written to out
+        """
+        round_keys = KEY_SCHEDULE_CACHE.encryption_keys(key)
+        plain_text = memoryview(plain_text).cast('B')
+        out = memoryview(out).cast('B')
+        length = self.encrypted_length(len(plain_text))
+        if len(out) < length:
+            raise ValueError(
+                f"Output buffer is {len(out)} bytes but {length} bytes are needed")
+
         # Encrpytion Algorithm - encrypts in blocks of 16 bytes
-        for i in range(0, len(padded_plain_text), 16):
-            block = padded_plain_text[i:i+16]
-            block = self.bytes_to_matrix(block)
-            # Start of actual encryption
-            # XOR with IV before this step.
-
-            block = self.xor_key(block, 0, key_schedule)
-            for round in range(1, 10):
-                block = self.sub_bytes(block, True)
-                block = self.rotate(
-                    self.encrypt_shift_rows(self.rotate(block)))
-                block = self.mix_columns(block, True)
-                block = self.xor_key(block, round, key_schedule)
-            block = self.sub_bytes(block, True)
-            block = self.rotate(self.encrypt_shift_rows(self.rotate(block)))
-            block = self.xor_key(block, 10, key_schedule)
-            # IV = block
-            cipher_text.append(block)
-
-        # Convert the flattened list to a continuous byte stream
-            # flattened_cipher_text = [
-            #     byte for sublist in cipher_text for byte in sublist]
-
-            # Decode the bytes to UTF-8
-            # utf8_result = bytes(flattened_cipher_text)
-            ct = sum(sum(cipher_text, []), [])
-        return bytes(ct)
+        full_blocks = len(plain_text) - len(plain_text) % 16
+        self.encrypt_blocks(plain_text[:full_blocks], out, round_keys)
+        # only the final block needs padding so the rest of the data is never copied
+        final_block = self.padding(bytes(plain_text[full_blocks:]))
+        self.encrypt_blocks(final_block, out[full_blocks:length], round_keys)
+        return length
+
+    def encrypted_length(self, length: int) -> int:
+        """Returns the length of the cipher text for length bytes of plain text"""
+        return (length // 16 + 1) * 16
+
+    def encrypt_block(self, block: bytes, round_keys: tuple) -> bytes:
+        """Encrypts one 16 byte block using the T tables. round_keys should come from round_key_words"""
+        out = bytearray(16)
+        self.encrypt_blocks(block, out, round_keys)
+        return bytes(out)
+
+    def encrypt_blocks(self, src, dst, round_keys: tuple):
+        """
+        Encrypts every whole block in src writing it to the same position in dst
+
+        src and dst can be the same buffer to encrypt in place
+        """
+        # local names are quicker to look up inside the loop
+        te0, te1, te2, te3, s_box = TE0, TE1, TE2, TE3, S_BOX
+        unpack_from, pack_into = BLOCK.unpack_from, BLOCK.pack_into
+        k0, k1, k2, k3 = round_keys[0:4]
+        for offset in range(0, len(src) - 15, 16):
+            s0, s1, s2, s3 = unpack_from(src, offset)
+            s0 ^= k0
+            s1 ^= k1
+            s2 ^= k2
+            s3 ^= k3
+            # rounds 1-9 - each table lookup does sub bytes, shift rows and mix columns for one byte
+            for k in range(4, 40, 4):
+                t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xff] ^ te2[(s2 >> 8) & 0xff] ^ te3[s3 & 0xff] ^ round_keys[k]
+                t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xff] ^ te2[(s3 >> 8) & 0xff] ^ te3[s0 & 0xff] ^ round_keys[k+1]
+                t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xff] ^ te2[(s0 >> 8) & 0xff] ^ te3[s1 & 0xff] ^ round_keys[k+2]
+                t3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xff] ^ te2[(s1 >> 8) & 0xff] ^ te3[s2 & 0xff] ^ round_keys[k+3]
+                s0, s1, s2, s3 = t0, t1, t2, t3
+            # final round has no mix columns
+            pack_into(dst, offset,
+                      (s_box[s0 >> 24] << 24 | s_box[(s1 >> 16) & 0xff] << 16 | s_box[(s2 >> 8) & 0xff] << 8 | s_box[s3 & 0xff]) ^ round_keys[40],
+                      (s_box[s1 >> 24] << 24 | s_box[(s2 >> 16) & 0xff] << 16 | s_box[(s3 >> 8) & 0xff] << 8 | s_box[s0 & 0xff]) ^ round_keys[41],
+                      (s_box[s2 >> 24] << 24 | s_box[(s3 >> 16) & 0xff] << 16 | s_box[(s0 >> 8) & 0xff] << 8 | s_box[s1 & 0xff]) ^ round_keys[42],
+                      (s_box[s3 >> 24] << 24 | s_box[(s0 >> 16) & 0xff] << 16 | s_box[(s1 >> 8) & 0xff] << 8 | s_box[s2 & 0xff]) ^ round_keys[43])
 
     def padding(self, data: bytes) -> bytes:
         """padds data to become a multiple of 128 bits"""
@@ -209,44 +419,486 @@ class Encrypt(SharedFunctions):
 class Decrypt(SharedFunctions):
 
     def decrypt(self, cipher_text: bytes, key: bytes) -> bytes:
-        plain_text = []
-        key_schedule = self.key_expansion(key)
+        plain_text = bytearray(len(cipher_text))
+        length = self.decrypt_into(cipher_text, key, plain_text)
+        return bytes(memoryview(plain_text)[:length])
+
+    def decrypt_into(self, cipher_text: bytes, key: bytes, out) -> int:
+        """
+        Decrypts cipher_text straight into a caller supplied buffer
+
+        Parameters:
+        - out (bytearray/memoryview): must be at least len(cipher_text) bytes as the padding is written too
+
+        Returns the length of the plain text in out with the padding removed
+        """
+        inverse_keys = KEY_SCHEDULE_CACHE.decryption_keys(key)
+        cipher_text = memoryview(cipher_text).cast('B')
+        out = memoryview(out).cast('B')
+        if len(cipher_text) == 0 or len(cipher_text) % 16 != 0:
+            raise ValueError("Cipher text is not a multiple of 16 bytes")
+        if len(out) < len(cipher_text):
+            raise ValueError(
+                f"Output buffer is {len(out)} bytes but {len(cipher_text)} bytes are needed")
+
         # Decryption Algorithm - decrypts in blocks of 16 bytes
+        self.decrypt_blocks(cipher_text, out, inverse_keys)
+        # x = final byte, remove x ammount of bytes from the end
+        return len(cipher_text) - out[len(cipher_text) - 1]
 
-        for i in range(0, len(cipher_text), 16):
-            block = cipher_text[i:i+16]
-            block = self.bytes_to_matrix(block)
-
-            # STARTING THE ACTUAL DECRYPTION NOW BABY
-            block = self.xor_key(block, 10, key_schedule)
-            block = self.rotate(self.decrypt_shift_rows(self.rotate(block)))
-            block = self.sub_bytes(block, False)
-            for round in range(1, 10):
-                block = self.xor_key(block, 10-round, key_schedule)
-                block = self.mix_columns(block, False)
-                block = self.rotate(
-                    self.decrypt_shift_rows(self.rotate(block)))
-                block = self.sub_bytes(block, False)
-            block = self.xor_key(block, 0, key_schedule)
-            plain_text.append(block)
-
-        # flattened_plain_text = [
-        #    byte for sublist in plain_text for byte in sublist]
-        pt = self.remove_padding(plain_text)
-
-        # ptt = sum(sum(pt, []), [])
-
-        return bytes(pt)
-        # plain_text = self.remove_padding(plain_text)
-        # return (''.join(map(chr, plain_text))).encode()
-
-    def remove_padding(self, data):
+    def decrypt_batch(self, items: list, use_numpy: bool = True) -> list:
+        """
+        Decrypts many independent cipher texts at once
+
+        Parameters:
+        - items (list): (cipher_text, key) pairs
+        - use_numpy (bool): set False to force the pure python path
+
+        Returns the plain texts in the same order as items
+        """
+        if not items:
+            return []
+        if not (use_numpy and NUMPY_AVAILABLE):
+            return [self.decrypt(cipher_text, key) for cipher_text, key in items]
+        return self.numpy_decrypt_batch(items)
+
+    def numpy_decrypt_batch(self, items: list) -> list:
+        """
+        Decrypts every block of every item in lockstep using the T tables as 
+        numpy arrays. Each round is a handful of gathers over all the blocks 
+        rather than a python loop per block
+        """
+        lengths = []
+        key_indexes = {}  # key bytes -> row in key_table
+        block_keys = []  # row in key_table for every block
+        for cipher_text, key in items:
+            if len(cipher_text) == 0 or len(cipher_text) % 16 != 0:
+                raise ValueError("Cipher text is not a multiple of 16 bytes")
+            key = bytes(key)
+            if key not in key_indexes:
+                key_indexes[key] = len(key_indexes)
+            lengths.append(len(cipher_text))
+            block_keys.extend([key_indexes[key]] * (len(cipher_text) // 16))
+
+        key_table = np.array([KEY_SCHEDULE_CACHE.decryption_keys(key) for key in key_indexes],
+                             dtype=np.uint32)
+        round_keys = key_table[np.array(block_keys)]  # (blocks, 44) keys used by each block
+        state = np.frombuffer(b''.join(bytes(cipher_text) for cipher_text, key in items),
+                              dtype='>u4').reshape(-1, 4).astype(np.uint32)
+
+        s0, s1, s2, s3 = (state[:, i] ^ round_keys[:, i] for i in range(4))
+        for k in range(4, 40, 4):
+            t0 = NP_TD0[s0 >> 24] ^ NP_TD1[(s3 >> 16) & 0xff] ^ NP_TD2[(s2 >> 8) & 0xff] ^ NP_TD3[s1 & 0xff] ^ round_keys[:, k]
+            t1 = NP_TD0[s1 >> 24] ^ NP_TD1[(s0 >> 16) & 0xff] ^ NP_TD2[(s3 >> 8) & 0xff] ^ NP_TD3[s2 & 0xff] ^ round_keys[:, k+1]
+            t2 = NP_TD0[s2 >> 24] ^ NP_TD1[(s1 >> 16) & 0xff] ^ NP_TD2[(s0 >> 8) & 0xff] ^ NP_TD3[s3 & 0xff] ^ round_keys[:, k+2]
+            t3 = NP_TD0[s3 >> 24] ^ NP_TD1[(s2 >> 16) & 0xff] ^ NP_TD2[(s1 >> 8) & 0xff] ^ NP_TD3[s0 & 0xff] ^ round_keys[:, k+3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+        inverse_s_box = NP_INVERSE_S_BOX
+        state = np.stack((
+            (inverse_s_box[s0 >> 24] << 24 | inverse_s_box[(s3 >> 16) & 0xff] << 16 | inverse_s_box[(s2 >> 8) & 0xff] << 8 | inverse_s_box[s1 & 0xff]) ^ round_keys[:, 40],
+            (inverse_s_box[s1 >> 24] << 24 | inverse_s_box[(s0 >> 16) & 0xff] << 16 | inverse_s_box[(s3 >> 8) & 0xff] << 8 | inverse_s_box[s2 & 0xff]) ^ round_keys[:, 41],
+            (inverse_s_box[s2 >> 24] << 24 | inverse_s_box[(s1 >> 16) & 0xff] << 16 | inverse_s_box[(s0 >> 8) & 0xff] << 8 | inverse_s_box[s3 & 0xff]) ^ round_keys[:, 42],
+            (inverse_s_box[s3 >> 24] << 24 | inverse_s_box[(s2 >> 16) & 0xff] << 16 | inverse_s_box[(s1 >> 8) & 0xff] << 8 | inverse_s_box[s0 & 0xff]) ^ round_keys[:, 43]),
+            axis=1)
+        plain_text = state.astype('>u4').tobytes()
+
+        # splitting back into the original items and removing the padding
+        plain_texts = []
+        offset = 0
+        for length in lengths:
+            end = offset + length
+            plain_texts.append(plain_text[offset:end - plain_text[end - 1]])
+            offset = end
+        return plain_texts
+
+    def decrypt_block(self, block: bytes, inverse_keys: tuple) -> bytes:
+        """Decrypts one 16 byte block using the T tables. inverse_keys should come from inverse_round_key_words"""
+        out = bytearray(16)
+        self.decrypt_blocks(block, out, inverse_keys)
+        return bytes(out)
+
+    def decrypt_blocks(self, src, dst, inverse_keys: tuple):
+        """
+        Decrypts every whole block in src writing it to the same position in dst
+
+        src and dst can be the same buffer to decrypt in place
+        """
+        td0, td1, td2, td3, inverse_s_box = TD0, TD1, TD2, TD3, INVERSE_S_BOX
+        unpack_from, pack_into = BLOCK.unpack_from, BLOCK.pack_into
+        k0, k1, k2, k3 = inverse_keys[0:4]
+        for offset in range(0, len(src) - 15, 16):
+            s0, s1, s2, s3 = unpack_from(src, offset)
+            s0 ^= k0
+            s1 ^= k1
+            s2 ^= k2
+            s3 ^= k3
+            # rounds 9-1 - shift rows goes the other way so the columns are read in reverse
+            for k in range(4, 40, 4):
+                t0 = td0[s0 >> 24] ^ td1[(s3 >> 16) & 0xff] ^ td2[(s2 >> 8) & 0xff] ^ td3[s1 & 0xff] ^ inverse_keys[k]
+                t1 = td0[s1 >> 24] ^ td1[(s0 >> 16) & 0xff] ^ td2[(s3 >> 8) & 0xff] ^ td3[s2 & 0xff] ^ inverse_keys[k+1]
+                t2 = td0[s2 >> 24] ^ td1[(s1 >> 16) & 0xff] ^ td2[(s0 >> 8) & 0xff] ^ td3[s3 & 0xff] ^ inverse_keys[k+2]
+                t3 = td0[s3 >> 24] ^ td1[(s2 >> 16) & 0xff] ^ td2[(s1 >> 8) & 0xff] ^ td3[s0 & 0xff] ^ inverse_keys[k+3]
+                s0, s1, s2, s3 = t0, t1, t2, t3
+            pack_into(dst, offset,
+                      (inverse_s_box[s0 >> 24] << 24 | inverse_s_box[(s3 >> 16) & 0xff] << 16 | inverse_s_box[(s2 >> 8) & 0xff] << 8 | inverse_s_box[s1 & 0xff]) ^ inverse_keys[40],
+                      (inverse_s_box[s1 >> 24] << 24 | inverse_s_box[(s0 >> 16) & 0xff] << 16 | inverse_s_box[(s3 >> 8) & 0xff] << 8 | inverse_s_box[s2 & 0xff]) ^ inverse_keys[41],
+                      (inverse_s_box[s2 >> 24] << 24 | inverse_s_box[(s1 >> 16) & 0xff] << 16 | inverse_s_box[(s0 >> 8) & 0xff] << 8 | inverse_s_box[s3 & 0xff]) ^ inverse_keys[42],
+                      (inverse_s_box[s3 >> 24] << 24 | inverse_s_box[(s2 >> 16) & 0xff] << 16 | inverse_s_box[(s1 >> 8) & 0xff] << 8 | inverse_s_box[s0 & 0xff]) ^ inverse_keys[43])
+
+    def remove_padding(self, data: bytes) -> bytes:
         # x = final character in string
         # remove x ammount of characters from end of string
-        data = sum(sum(data, []), [])  # moving from 3D list to 1D list
         return data[:-data[-1]]
 
     def decrypt_shift_rows(slef, block):
         for i in range(4):
             block[i] = block[i][-i:] + block[i][:-i]
         return block
+
+
+class StreamEncryptor(Encrypt):
+    """
+    Encrypts data a chunk at a time. 
+
+    Call update() with each chunk and finalize() once at the end - the 
+    joined output is the same as Encrypt().encrypt() on the whole data
+    """
+
+    def __init__(self, key: bytes):
+        self.round_keys = KEY_SCHEDULE_CACHE.encryption_keys(key)
+        self.__buffer = bytearray()  # never holds more than 15 bytes between calls
+        self.finalized = False
+
+    def update(self, chunk: bytes) -> bytes:
+        """Returns the cipher text for every whole block available so far"""
+        if self.finalized:
+            raise ValueError("update() called after finalize()")
+        self.__buffer += chunk
+        full_blocks = len(self.__buffer) - len(self.__buffer) % 16
+        cipher_text = bytearray(full_blocks)
+        with memoryview(self.__buffer) as view:
+            self.encrypt_blocks(view[:full_blocks], cipher_text, self.round_keys)
+        del self.__buffer[:full_blocks]
+        return bytes(cipher_text)
+
+    def finalize(self) -> bytes:
+        """Pads and encrypts the remaining bytes. Can only be called once"""
+        if self.finalized:
+            raise ValueError("finalize() called twice")
+        self.finalized = True
+        cipher_text = bytearray(16)
+        self.encrypt_blocks(self.padding(bytes(self.__buffer)),
+                            cipher_text, self.round_keys)
+        self.__buffer.clear()
+        return bytes(cipher_text)
+
+
+class StreamDecryptor(Decrypt):
+    """
+    Decrypts data a chunk at a time.
+
+    The last block is held back until finalize() as it contains the padding
+    """
+
+    def __init__(self, key: bytes):
+        self.inverse_keys = KEY_SCHEDULE_CACHE.decryption_keys(key)
+        self.__buffer = bytearray()  # never holds more than 16 bytes between calls
+        self.finalized = False
+
+    def update(self, chunk: bytes) -> bytes:
+        """Returns the plain text for every whole block except the last one seen so far"""
+        if self.finalized:
+            raise ValueError("update() called after finalize()")
+        self.__buffer += chunk
+        # keeping at least one whole block back in case it is the final one
+        ready = len(self.__buffer) - len(self.__buffer) % 16
+        if ready == len(self.__buffer):
+            ready -= 16
+        if ready <= 0:
+            return b''
+        plain_text = bytearray(ready)
+        with memoryview(self.__buffer) as view:
+            self.decrypt_blocks(view[:ready], plain_text, self.inverse_keys)
+        del self.__buffer[:ready]
+        return bytes(plain_text)
+
+    def finalize(self) -> bytes:
+        """Decrypts the final block and removes the padding. Can only be called once"""
+        if self.finalized:
+            raise ValueError("finalize() called twice")
+        self.finalized = True
+        if len(self.__buffer) != 16:
+            raise ValueError("Cipher text is not a multiple of 16 bytes")
+        plain_text = bytearray(16)
+        self.decrypt_blocks(self.__buffer, plain_text, self.inverse_keys)
+        self.__buffer.clear()
+        return self.remove_padding(bytes(plain_text))
+
+
+class EncryptedWriter(io.RawIOBase):
+    """
+    File like object that encrypts everything written to it before writing 
+    it to fileobj. The padding is written when it is closed.
+
+    fileobj is not closed with the writer
+    """
+
+    def __init__(self, fileobj, key: bytes):
+        self.fileobj = fileobj
+        self.encryptor = StreamEncryptor(key)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.fileobj.write(self.encryptor.update(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.write(self.encryptor.finalize())
+        super().close()
+
+
+class DecryptedReader(io.RawIOBase):
+    """
+    File like object that reads and decrypts fileobj chunk_size bytes at a 
+    time as it is read from
+
+    fileobj is not closed with the reader
+    """
+
+    def __init__(self, fileobj, key: bytes, chunk_size: int = CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.decryptor = StreamDecryptor(key)
+        self.chunk_size = chunk_size
+        self.__plain_text = bytearray()
+        self.__end_of_file = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.__plain_text and not self.__end_of_file:
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.__plain_text += self.decryptor.update(chunk)
+            else:
+                self.__plain_text += self.decryptor.finalize()
+                self.__end_of_file = True
+        size = min(len(buffer), len(self.__plain_text))
+        buffer[:size] = self.__plain_text[:size]
+        del self.__plain_text[:size]
+        return size
+
+
+def _counter_mode_worker(data: bytes, key: bytes, counter: int) -> bytes:
+    """Runs CTR mode on one chunk in a worker process. Module level so it can be pickled"""
+    return CounterMode().keystream_xor(data, key, counter)
+
+
+class CounterMode():
+    """
+    AES in counter (CTR) mode. 
+
+    Every block is encrypted independently so payloads of parallel_threshold
+    bytes or more are split between max_workers processes. There is no 
+    padding so the output is the same length as the input, and decrypting 
+    is the same operation as encrypting. 
+
+    The initial counter block must never be reused with the same key
+    """
+
+    def __init__(self, max_workers: int = None, parallel_threshold: int = PARALLEL_THRESHOLD):
+        # held rather than inherited so the padded ECB encrypt methods are not offered here
+        self.block_cipher = Encrypt()
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self.__pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def encrypt(self, data: bytes, key: bytes, initial_counter: bytes) -> bytes:
+        """
+        Parameters:
+        - initial_counter (bytes): 16 byte counter block for the first block of data, incremented for each block after
+        """
+        if len(initial_counter) != 16:
+            raise ValueError("initial_counter must be 16 bytes")
+        return self.xor_from_counter(data, key, int.from_bytes(initial_counter, 'big'))
+
+    def decrypt(self, data: bytes, key: bytes, initial_counter: bytes) -> bytes:
+        return self.encrypt(data, key, initial_counter)
+
+    def xor_from_counter(self, data: bytes, key: bytes, counter: int) -> bytes:
+        """XORs data with the keystream starting at counter, using the process pool for large data"""
+        if len(data) < self.parallel_threshold or self.max_workers < 2:
+            return self.keystream_xor(data, key, counter)
+        return self.parallel_keystream_xor(data, key, counter)
+
+    def keystream_xor(self, data: bytes, key: bytes, counter: int) -> bytes:
+        """XORs data with the keystream starting at counter in this process"""
+        length = len(data)
+        blocks = (length + 15) // 16
+        keystream = bytearray(blocks * 16)
+        pack_into = COUNTER_BLOCK.pack_into
+        for i in range(blocks):
+            block_counter = (counter + i) & 0xffffffffffffffffffffffffffffffff  # wraps at 2^128
+            pack_into(keystream, i * 16, block_counter >> 64,
+                      block_counter & 0xffffffffffffffff)
+        self.block_cipher.encrypt_blocks(keystream, keystream,
+                                         KEY_SCHEDULE_CACHE.encryption_keys(key))
+        # xoring as two big ints is much quicker than byte by byte
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(keystream[:length], 'big')).to_bytes(length, 'big')
+
+    def parallel_keystream_xor(self, data: bytes, key: bytes, counter: int) -> bytes:
+        """Splits data on block boundaries and runs each chunk in the process pool"""
+        data = memoryview(data).cast('B')
+        chunk_size = -(-len(data) // self.max_workers)
+        chunk_size += -chunk_size % 16
+        pool = self.get_pool()
+        futures = [pool.submit(_counter_mode_worker, bytes(data[i:i+chunk_size]), bytes(key), counter + i // 16)
+                   for i in range(0, len(data), chunk_size)]
+        return b''.join(future.result() for future in futures)
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        """Returns the process pool creating it the first time it is needed"""
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.__pool
+
+    def close(self):
+        """Shuts down the process pool if one was started"""
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+
+class EncryptedAttachmentWriter(io.RawIOBase):
+    """
+    File like object that writes a seekable encrypted attachment to fileobj.
+
+    Layout: ATTACHMENT_HEADER followed by the data encrypted in counter mode
+    starting at the initial counter in the header. As counter mode keeps the
+    length the same the plain text size is the file size minus the header
+
+    One process by default as a pool started in the GUI client would re-import
+    it when processes are spawned - large writes are only split between
+    processes if max_workers is passed. fileobj is not closed with the writer
+    """
+
+    def __init__(self, fileobj, key: bytes, initial_counter: bytes = None, max_workers: int = 1):
+        self.fileobj = fileobj
+        self.key = key
+        self.counter_mode = CounterMode(max_workers=max_workers)
+        if initial_counter is None:
+            initial_counter = os.urandom(16)  # random so a counter is never reused with the same key
+        self.fileobj.write(ATTACHMENT_HEADER.pack(
+            ATTACHMENT_MAGIC, ATTACHMENT_VERSION, initial_counter))
+        self.__counter = int.from_bytes(initial_counter, 'big')
+        self.__buffer = bytearray()  # never holds more than 15 bytes between calls
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.__buffer += data
+        full_blocks = len(self.__buffer) - len(self.__buffer) % 16
+        if full_blocks:
+            self.fileobj.write(self.counter_mode.xor_from_counter(
+                bytes(self.__buffer[:full_blocks]), self.key, self.__counter))
+            self.__counter += full_blocks // 16
+            del self.__buffer[:full_blocks]
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.__buffer:
+            # no padding in counter mode so the last partial block is written as is
+            self.fileobj.write(self.counter_mode.keystream_xor(
+                bytes(self.__buffer), self.key, self.__counter))
+            self.__buffer.clear()
+        self.counter_mode.close()
+        super().close()
+
+
+class EncryptedAttachmentReader(io.RawIOBase):
+    """
+    Seekable file like object that decrypts an attachment written by 
+    EncryptedAttachmentWriter. Only the blocks covering the bytes actually 
+    read are decrypted so reading an image header does not decrypt the image.
+    Like the writer it runs in one process unless max_workers is passed
+
+    fileobj must be seekable and is only closed with the reader if closefd is True
+    """
+
+    def __init__(self, fileobj, key: bytes, closefd: bool = False, max_workers: int = 1):
+        self.fileobj = fileobj
+        self.key = key
+        self.closefd = closefd
+        self.counter_mode = CounterMode(max_workers=max_workers)
+        fileobj.seek(0)
+        header = fileobj.read(ATTACHMENT_HEADER.size)
+        if len(header) != ATTACHMENT_HEADER.size:
+            raise ValueError("Not an encrypted attachment")
+        magic, version, initial_counter = ATTACHMENT_HEADER.unpack(header)
+        if magic != ATTACHMENT_MAGIC or version != ATTACHMENT_VERSION:
+            raise ValueError("Not an encrypted attachment")
+        self.initial_counter = int.from_bytes(initial_counter, 'big')
+        self.size = fileobj.seek(0, io.SEEK_END) - ATTACHMENT_HEADER.size
+        self.__position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.__position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.__position = offset
+        return self.__position
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """Returns the plain text from byte start up to (not including) byte end"""
+        end = min(end, self.size)
+        if start >= end:
+            return b''
+        first_block = start // 16
+        last_block = (end + 15) // 16
+        self.fileobj.seek(ATTACHMENT_HEADER.size + first_block * 16)
+        cipher_text = self.fileobj.read((last_block - first_block) * 16)
+        plain_text = self.counter_mode.xor_from_counter(
+            cipher_text, self.key, self.initial_counter + first_block)
+        return plain_text[start - first_block * 16:end - first_block * 16]
+
+    def readinto(self, buffer) -> int:
+        data = self.read_range(self.__position, self.__position + len(buffer))
+        buffer[:len(data)] = data
+        self.__position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed and self.closefd:
+            self.fileobj.close()
+        self.counter_mode.close()
+        super().close()
+
+
+def is_encrypted_attachment(fileobj) -> bool:
+    """Checks the start of fileobj for the attachment header leaving the position unchanged"""
+    position = fileobj.tell()
+    magic = fileobj.read(len(ATTACHMENT_MAGIC))
+    fileobj.seek(position)
+    return magic == ATTACHMENT_MAGIC
@@ -0,0 +1,144 @@
+"""
+Process pool for the servers RSA and AES work.
+
+RSA private key operations (and AES when the pure python backend is in use)
+hold the GIL, so doing them on a connections thread stalls every other
+connection. CryptoPool runs them in worker processes instead - callers
+block on (or await) the result while the GIL is free for other connections.
+
+The servers private key is sent to each worker once when it starts rather
+than with every job.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import rsa
+
+import aes_backends
+
+
+AES_OFFLOAD_THRESHOLD = 64 * 1024  # smaller AES jobs cost more to send to a worker than to do
+
+# worker process state - set by _init_worker
+_private_key = None
+_cipher = None
+
+
+def _init_worker(private_key: rsa.PrivateKey):
+    global _private_key, _cipher
+    _private_key = private_key
+    _cipher = aes_backends.get_backend()
+
+
+def _rsa_decrypt(cipher_text: bytes) -> bytes:
+    return rsa.decrypt(cipher_text, _private_key)
+
+
+def _rsa_sign(data: bytes) -> bytes:
+    return rsa.sign(data, _private_key, 'SHA-1')
+
+
+def _rsa_verify(data: bytes, signature: bytes, public_key: rsa.PublicKey) -> bool:
+    try:
+        rsa.verify(data, signature, public_key)
+        return True
+    except Exception:
+        return False
+
+
+def _aes_encrypt(plain_text: bytes, key: bytes) -> bytes:
+    return _cipher.encrypt(plain_text, key)
+
+
+def _aes_decrypt(cipher_text: bytes, key: bytes) -> bytes:
+    return _cipher.decrypt(cipher_text, key)
+
+
+class CryptoPool():
+    """
+    Runs RSA and AES jobs with the servers private key in worker processes
+
+    Every job is timed from when it is submitted to when its result is ready,
+    so latency includes any time spent waiting for a free worker
+    """
+
+    def __init__(self, private_key: rsa.PrivateKey, max_workers: int = None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.private_key = private_key
+        # AES is only worth sending to a worker if it is done in pure python
+        self.offload_aes = aes_backends.get_backend().name == aes_backends.PurePythonBackend.name
+        self.__pool = None
+        self.lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.queue_depth = 0  # jobs submitted but not finished
+        self.max_queue_depth = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self.jobs = {}  # job name -> number submitted
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        """Returns the process pool creating it the first time it is needed"""
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_init_worker,
+                                              initargs=(self.private_key,))
+        return self.__pool
+
+    def run(self, function, *args):
+        """Runs function(*args) in a worker process waiting for the result"""
+        start = time.perf_counter()
+        with self.lock:
+            self.submitted += 1
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            self.jobs[function.__name__] = self.jobs.get(function.__name__, 0) + 1
+        try:
+            return self.get_pool().submit(function, *args).result()
+        finally:
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.completed += 1
+                self.queue_depth -= 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def rsa_decrypt(self, cipher_text: bytes) -> bytes:
+        return self.run(_rsa_decrypt, cipher_text)
+
+    def rsa_sign(self, data: bytes) -> bytes:
+        return self.run(_rsa_sign, bytes(data))
+
+    def rsa_verify(self, data: bytes, signature: bytes, public_key: rsa.PublicKey) -> bool:
+        return self.run(_rsa_verify, bytes(data), signature, public_key)
+
+    def should_offload_aes(self, data: bytes) -> bool:
+        return self.offload_aes and len(data) >= AES_OFFLOAD_THRESHOLD
+
+    def aes_encrypt(self, plain_text: bytes, key: bytes) -> bytes:
+        return self.run(_aes_encrypt, bytes(plain_text), key)
+
+    def aes_decrypt(self, cipher_text: bytes, key: bytes) -> bytes:
+        return self.run(_aes_decrypt, bytes(cipher_text), key)
+
+    def metrics(self) -> dict:
+        """Returns the job counts, queue depth and latency (in seconds) so far"""
+        with self.lock:
+            return {
+                'workers': self.max_workers,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'average_latency': self.total_latency / self.completed if self.completed else 0,
+                'max_latency': self.max_latency,
+                'jobs': dict(self.jobs),
+            }
+
+    def close(self):
+        """Shuts down the process pool if one was started"""
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
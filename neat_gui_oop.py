@@ -1072,9 +1072,9 @@ class ChatPage(tk.Frame):
         image_path = self.client.image_path
 
         # global image
-        unprocessed_image = Image.open(image_path)
-
-        image = ImageTk.PhotoImage(unprocessed_image)
+        with self.client.open_stored_image(image_path) as image_file:
+            unprocessed_image = Image.open(image_file)
+            image = ImageTk.PhotoImage(unprocessed_image)
         self.images.append(image)
 
         self.message_display_box.config(state='normal')
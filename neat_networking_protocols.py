@@ -3,16 +3,89 @@ Provides a base class with generic send/recieve functions but with in built data
 """
 # Cryptography imports
 import rsa
-import class_based_aes as aes
+import aes_backends
+import public_keys
+import hmac
+import hashlib
+import secrets
+import time
 
 # Data serialization imports
+import io
 import json
 import pickle
 import base64
+import struct
+import zlib
 
+import socket
+import asyncio
+import functools
+import threading
 
-HEADER = 2048  # used for send message protocol
+
+HEADER = 2048  # used for the legacy send message protocol
 FORMAT = 'utf-8'
+
+# Binary framing - one frame carries a whole logical message (data + signature)
+# magic, version, frame type, flags, data length, signature length
+FRAME_HEADER = struct.Struct('!BBBBII')
+FRAME_MAGIC = 0xA5  # legacy headers start with an ascii digit so can never start with this
+FRAME_VERSION = 1
+TCP_NODELAY = True  # turn off Nagle's algorithm so small chat frames are not held back
+RECEIVE_BUFFER_SIZE = 64 * 1024  # starting size of each connections receive buffer
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # largest frame the receive buffer will grow to
+# frame types
+FRAME_SIGNED = 1  # data sent with send_data
+FRAME_ENCRYPTED = 2  # lump data sent with send_encrypted_data or forwarded
+FRAME_SESSION = 3  # client-server data protected by the session keys - data is sequence + cipher text, signature is the HMAC tag
+# frame flags
+FLAG_BINARY_CODEC = 0x01  # data and signature use the binary codec instead of JSON
+FLAG_ROUTED = 0x02  # data starts with a route so the server can forward it without decoding it
+FLAG_COMPRESSED = 0x04  # session frame data was compressed before it was encrypted
+
+# Routes - message kind and recipient user id length followed by the utf-8 user id
+ROUTE_HEADER = struct.Struct('!BH')
+ROUTE_OTHER = 0
+ROUTE_MESSAGE = 1
+ROUTE_KINDS = {'message': ROUTE_MESSAGE}
+
+# Serialization codecs
+CODEC_JSON = 'json'  # JSON with bytes and objects base64 encoded (the only one legacy clients understand)
+CODEC_BINARY = 'binary'  # tag-length-value with native bytes and ints
+DEFAULT_CODEC = CODEC_BINARY  # used by clients - servers reply with whichever codec the client used
+# binary codec tags - every value is one tag byte followed by its contents
+TAG_NONE = 0x00
+TAG_FALSE = 0x01
+TAG_TRUE = 0x02
+TAG_INT = 0x03  # 8 byte signed int
+TAG_BIG_INT = 0x04  # u32 length then signed big endian bytes
+TAG_FLOAT = 0x05
+TAG_STR = 0x06  # u32 length then utf-8
+TAG_BYTES = 0x07  # u32 length then the bytes
+TAG_LIST = 0x08  # u32 count then each item (tuples are sent as lists)
+TAG_DICT = 0x09  # u32 count then each key and value
+# 0x0A was pickled objects - never accepted so a frame can't make the other end unpickle anything
+TAG_PUBLIC_KEY = 0x0B  # u32 length then the PKCS#1 DER key (so keys are never unpickled)
+TAG = struct.Struct('!B')
+LENGTH = struct.Struct('!I')
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+
+# Compression - before encryption so there is less to encrypt
+COMPRESSION = True  # clients ask for compression when swapping public keys
+COMPRESSION_LEVEL = 6  # zlib level 1 (fastest) to 9 (smallest)
+COMPRESSION_THRESHOLD = 256  # smaller payloads are sent as they are
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+# Sessions - set up once per public key swap so client-server messages don't need RSA
+USE_SESSIONS = True  # clients ask for a session when swapping public keys
+SESSION_SECRET_SIZE = 32
+SEQUENCE = struct.Struct('!Q')
+
+# Conversation keys - one per friend and direction so messages don't need RSA
+CONVERSATION_KEY_MAX_MESSAGES = 1000  # messages sent before the key is rotated
+CONVERSATION_KEY_MAX_AGE = 8 * 60 * 60  # seconds before the key is rotated
 # PORT = 65432  # TCP/UDP packets
 # SERVER = "192.168.0.30"
 # ADDR = (SERVER, PORT)
@@ -22,22 +95,163 @@ class ClientDisconnectException(Exception):
     pass
 
 
-class BaseClass(aes.Encrypt, aes.Decrypt):
-    def __init__(self, cs: str, client, addr):
+class SessionAuthenticationError(Exception):
+    pass
+
+
+def derive_key(secret: bytes, label: bytes) -> bytes:
+    """Returns a 32 byte key for label derived from secret"""
+    return hmac.new(secret, label, hashlib.sha256).digest()
+
+
+class Session():
+    """
+    Keys and sequence numbers for one client-server session
+
+    Each direction has its own encryption and HMAC key derived from the
+    shared secret so a frame can't be reflected back to its sender
+    """
+
+    def __init__(self, secret: bytes, is_client: bool):
+        client_keys = (derive_key(secret, b'client encryption'),
+                       derive_key(secret, b'client authentication'))
+        server_keys = (derive_key(secret, b'server encryption'),
+                       derive_key(secret, b'server authentication'))
+        if is_client:
+            self.send_key, self.send_mac_key = client_keys
+            self.receive_key, self.receive_mac_key = server_keys
+        else:
+            self.send_key, self.send_mac_key = server_keys
+            self.receive_key, self.receive_mac_key = client_keys
+        self.send_sequence = 0
+        self.receive_sequence = 0
+
+    def message_key(self, key: bytes, sequence: int) -> bytes:
+        """Returns the AES key for one message so no two messages share a key"""
+        return hmac.new(key, SEQUENCE.pack(sequence), hashlib.sha256).digest()[:16]
+
+    def tag(self, mac_key: bytes, flags: int, body: bytes) -> bytes:
+        """Returns the HMAC of a session frame's flags and body (sequence + cipher text)"""
+        mac = hmac.new(mac_key, bytes((FRAME_SESSION, flags)), hashlib.sha256)
+        mac.update(body)
+        return mac.digest()
+
+
+class ConversationKey():
+    """
+    A key one friend uses to send messages to another
+
+    It is sent once in an RSA envelope, then each message is encrypted under
+    a key derived from it and its sequence number and tagged with an HMAC
+    """
+
+    def __init__(self, key_id: str, secret: bytes, created: float = None, sequence: int = 0):
+        self.key_id = key_id
+        self.secret = secret
+        self.encryption_key = derive_key(secret, b'conversation encryption')
+        self.mac_key = derive_key(secret, b'conversation authentication')
+        self.created = time.time() if created is None else created
+        self.sequence = sequence  # last sequence number sent or recieved
+
+    def needs_rotating(self) -> bool:
+        return (self.sequence >= CONVERSATION_KEY_MAX_MESSAGES
+                or time.time() - self.created >= CONVERSATION_KEY_MAX_AGE)
+
+    def message_key(self, sequence: int) -> bytes:
+        """Returns the AES key for one message - stored like an Epk so message history is unchanged"""
+        return hmac.new(self.encryption_key, SEQUENCE.pack(sequence), hashlib.sha256).digest()[:16]
+
+    def tag(self, seralized_lump_data) -> bytes:
+        return hmac.new(self.mac_key, seralized_lump_data, hashlib.sha256).digest()
+
+
+class BaseClass():
+    def __init__(self, cs: str, client, addr, nodelay: bool = TCP_NODELAY):
         """
         Parameters:
         - type (str): Should be either 'SERVER' or 'CLIENT'.
         - client: (socket)
         - addr: (tuple)
+        - nodelay (bool): sets TCP_NODELAY on the socket
         """
         self.type = cs
         self.client = client
         self.addr = addr
+        self.set_nodelay(nodelay)
+        self.cipher = aes_backends.get_backend()
+        # None until the first frame is recieved - servers work out if the client is using legacy headers from it
+        self.legacy_framing = None if cs == 'SERVER' else False
+        # servers switch to the codec of each frame they recieve so replies can be read
+        self.codec = CODEC_JSON if cs == 'SERVER' else DEFAULT_CODEC
+        self.session = None  # set by start_session after the public keys are swapped
+        # servers only compress once the client says it can decompress when swapping public keys
+        self.compression = COMPRESSION if cs == 'CLIENT' else False
+        self.compression_level = COMPRESSION_LEVEL
+        # friend user id -> ConversationKey (only used by clients)
+        self.sending_conversation_keys = {}
+        self.receiving_conversation_keys = {}
+        self.recipient_codecs = {}  # user id -> codec their client reads (from the server's public key lookups)
+        # reused for every frame so receiving does not allocate
+        self.header_buffer = bytearray(HEADER)
+        self.receive_buffer = bytearray(RECEIVE_BUFFER_SIZE)
+
+        # set by attach_streams when the connection is run by an asyncio event loop
+        self.reader = None
+        self.writer = None
+        self.loop = None
+        self.loop_thread_id = None
+        self.drain_lock = None
+        # the listening thread can send (a conversation key request) while another thread is sending
+        self.send_lock = threading.Lock()
+        self.executor = None  # where run_crypto runs CPU heavy work (None is the loops default executor)
+
+        # socket call counters for network_stats
+        self.bytes_sent = 0
+        self.send_calls = 0
+        self.bytes_received = 0
+        self.receive_calls = 0
+
+    def set_nodelay(self, enabled: bool):
+        """Turns TCP_NODELAY on or off for self.client"""
+        try:
+            self.client.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, int(enabled))
+        except (OSError, AttributeError):
+            pass  # not a TCP socket
+
+    def network_stats(self) -> dict:
+        """Returns the byte and socket call counters for this connection"""
+        return {
+            'bytes_sent': self.bytes_sent,
+            'send_calls': self.send_calls,
+            'bytes_per_send_call': self.bytes_sent / self.send_calls if self.send_calls else 0,
+            'bytes_received': self.bytes_received,
+            'receive_calls': self.receive_calls,
+            'bytes_per_receive_call': self.bytes_received / self.receive_calls if self.receive_calls else 0,
+        }
+
+    def encrypt(self, plain_text: bytes, key: bytes) -> bytes:
+        """Encrypts plain_text with the selected AES backend"""
+        return self.cipher.encrypt(plain_text, key)
+
+    def decrypt(self, cipher_text: bytes, key: bytes) -> bytes:
+        """Decrypts cipher_text with the selected AES backend"""
+        return self.cipher.decrypt(cipher_text, key)
+
+    def decrypt_batch(self, items: list) -> list:
+        """Decrypts a list of (cipher_text, key) pairs with the selected AES backend"""
+        return self.cipher.decrypt_batch(items)
+
+    def rsa_decrypt(self, cipher_text: bytes, private_key: rsa.PrivateKey) -> bytes:
+        """Decrypts an RSA encrypted Epk"""
+        return rsa.decrypt(cipher_text, private_key)
 
     def validate_signature(self, seralized_data, deseralized_signature) -> bool:
         """Validates a signature for argument passed into seralized_data """
         signature = deseralized_signature['signature']
         public_key = deseralized_signature['public_key']
+        if not isinstance(seralized_data, bytes):  # rsa only hashes bytes
+            seralized_data = bytes(seralized_data)
         valid = False
         try:
             rsa.verify(seralized_data, signature, public_key)
@@ -65,17 +279,401 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
         return send_length
 
     def send_with_header(self, data: bytes):
-        """Sends a fixed sized packet containing the number of bytes in the next packet"""
-        self.client.send(self.add_packet_header(data))
-        self.client.send(data)
+        """Sends a fixed sized packet containing the number of bytes in the next packet (legacy protocol)"""
+        self.send_buffers([self.add_packet_header(data), data])
+
+    def send_buffers(self, buffers: list):
+        """
+        Sends every buffer in order as one write. 
+
+        Uses scatter-gather sendmsg so the buffers are not joined first, 
+        only calling it again if the kernel takes part of the data
+        """
+        views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+        if self.writer is not None:
+            self.send_buffers_to_writer(views)
+            return
+        with self.send_lock:
+            if not hasattr(self.client, 'sendmsg'):  # windows
+                data = b''.join(views)
+                self.client.sendall(data)
+                self.send_calls += 1
+                self.bytes_sent += len(data)
+                return
+
+            while views:
+                sent = self.client.sendmsg(views)
+                self.send_calls += 1
+                self.bytes_sent += sent
+                # removing whatever was sent from the front
+                while views and sent >= len(views[0]):
+                    sent -= len(views[0])
+                    views.pop(0)
+                if sent:
+                    views[0] = views[0][sent:]
 
     def receive_data_with_header(self) -> bytes:
-        """Receives the header and handels relevant logic for receiving relevant data returning the json data"""
-        data_length = self.client.recv(HEADER).decode(FORMAT)
-        if data_length != 0:
-            data_length = int(data_length)
-            json_data = self.client.recv(data_length)
-            return json_data
+        """Receives the header and handels relevant logic for receiving relevant data returning the json data (legacy protocol)"""
+        data_length = int(self.receive_exactly(HEADER).decode(FORMAT))
+        return self.receive_exactly(data_length)
+
+    def receive_exactly(self, length: int) -> bytes:
+        """Keeps receiving until exactly length bytes have arrived"""
+        data = bytearray(length)
+        self.receive_exactly_into(memoryview(data))
+        return bytes(data)
+
+    def receive_exactly_into(self, view: memoryview, start_of_frame: bool = True):
+        """
+        Fills view from the socket with recv_into, looping over short reads
+
+        Timeouts are only passed on if nothing has been read at the start of a
+        frame, part way through one it keeps waiting so the stream stays in sync
+        """
+        received = 0
+        while received < len(view):
+            try:
+                count = self.client.recv_into(view[received:])
+            except socket.timeout:
+                if start_of_frame and received == 0:
+                    raise
+                continue
+            except OSError as e:  # reset or otherwise broken, same as the asyncio version
+                raise ClientDisconnectException('Connection closed') from e
+            if count == 0:
+                raise ClientDisconnectException('Connection closed')
+            received += count
+            self.receive_calls += 1
+            self.bytes_received += count
+
+    def get_receive_view(self, length: int, keep: int = 0) -> memoryview:
+        """
+        Returns a view of the first length bytes of the receive buffer, growing it if needed
+
+        keep is the number of bytes at the start of the buffer to copy over when it grows
+        """
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(
+                f"Frame of {length} bytes is bigger than MAX_FRAME_SIZE")
+        if length > len(self.receive_buffer):
+            new_buffer = bytearray(
+                min(max(length, 2 * len(self.receive_buffer)), MAX_FRAME_SIZE))
+            new_buffer[:keep] = self.receive_buffer[:keep]
+            self.receive_buffer = new_buffer
+        return memoryview(self.receive_buffer)[:length]
+
+    def send_frame(self, frame_type: int, data: bytes, signature: bytes, flags: int = 0, route: bytes = b''):
+        """
+        Sends data and its signature as one frame (or two legacy packets if the other end only supports those)
+
+        route is sent in front of data (without joining them) when FLAG_ROUTED is set
+        """
+        if self.legacy_framing:  # legacy clients can't read routes
+            self.send_buffers([self.add_packet_header(data), data,
+                               self.add_packet_header(signature), signature])
+        else:
+            self.send_buffers([FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, flags, len(route) + len(data), len(signature)),
+                               route, data, signature])
+
+    def route_header(self, recipient_user_id: str, message_type: str) -> bytes:
+        """Returns the route for a lump being sent to recipient_user_id through the server"""
+        encoded_user_id = recipient_user_id.encode(FORMAT)
+        return ROUTE_HEADER.pack(ROUTE_KINDS.get(message_type, ROUTE_OTHER), len(encoded_user_id)) + encoded_user_id
+
+    def read_route(self, data: memoryview) -> tuple:
+        """Returns (message kind, recipient user id, route length) from the start of a routed frames data"""
+        kind, user_id_length = ROUTE_HEADER.unpack_from(data)
+        route_length = ROUTE_HEADER.size + user_id_length
+        return kind, str(data[ROUTE_HEADER.size:route_length], FORMAT), route_length
+
+    def receive_frame(self) -> tuple:
+        """
+        Receives one logical message in either format into self.receive_buffer
+
+        Returns (frame_type, flags, data, signature). frame_type and flags are None for legacy packets.
+        data and signature are memoryviews of the receive buffer so are only valid until the next 
+        frame is received - copy them with bytes() to keep them
+        """
+        header = memoryview(self.header_buffer)
+        # a legacy header is longer than a frame header so this never reads past it
+        self.receive_exactly_into(header[:FRAME_HEADER.size])
+        frame_header = self.read_frame_header(header)
+        if frame_header is None:
+            return self.receive_legacy_frame(header)
+
+        frame_type, flags, data_length, signature_length = frame_header
+        body = self.get_receive_view(data_length + signature_length)
+        self.receive_exactly_into(body, False)
+        return frame_type, flags, body[:data_length], body[data_length:]
+
+    def read_frame_header(self, header: memoryview):
+        """
+        Reads the first FRAME_HEADER.size bytes of a frame
+
+        Returns (frame_type, flags, data_length, signature_length) or None if it is the start of a legacy header
+        """
+        if self.legacy_framing is None:
+            self.legacy_framing = header[0] != FRAME_MAGIC
+            if self.legacy_framing:
+                print(f"[LEGACY CLIENT] {self.addr} is using {HEADER} byte headers")
+
+        if header[0] != FRAME_MAGIC:
+            return None
+
+        magic, version, frame_type, flags, data_length, signature_length = FRAME_HEADER.unpack_from(
+            header)
+        if version != FRAME_VERSION:
+            raise ValueError(f"Unsupported frame version {version}")
+        if self.type == 'SERVER':
+            self.codec = self.frame_codec(flags)
+        return frame_type, flags, data_length, signature_length
+
+    def receive_legacy_frame(self, header: memoryview) -> tuple:
+        """Receives the rest of a legacy data packet and its signature packet after the first FRAME_HEADER.size bytes"""
+        self.receive_exactly_into(header[FRAME_HEADER.size:HEADER], False)
+        data_length = int(str(header, FORMAT))
+        self.receive_exactly_into(
+            self.get_receive_view(data_length), False)
+
+        self.receive_exactly_into(header, False)
+        signature_length = int(str(header, FORMAT))
+        body = self.get_receive_view(
+            data_length + signature_length, keep=data_length)
+        self.receive_exactly_into(body[data_length:], False)
+        return None, None, body[:data_length], body[data_length:]
+
+    # ------ASYNCIO------
+
+    def attach_streams(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Runs this connection on the current event loop instead of a blocking socket
+
+        Frames are then received with the async_ methods. The normal send methods still work
+        from the loop or from crypto threads (see send_buffers_to_writer)
+        """
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.drain_lock = asyncio.Lock()
+
+    def send_buffers_to_writer(self, views: list):
+        """Writes a frame to self.writer from the event loop or from any other thread"""
+        self.send_calls += 1
+        self.bytes_sent += sum(len(view) for view in views)
+        # copied as the views may be of a reused buffer - from Python 3.12 the transport
+        # keeps memoryviews it can't send straight away rather than copying them
+        data = b''.join(views)
+        if threading.get_ident() == self.loop_thread_id:
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    async def drain(self):
+        """Waits until self.writer's buffer is small enough to write to again"""
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    async def run_crypto(self, function, *args):
+        """Runs function in self.executor so the event loop is not blocked, then waits for anything it sent to be written"""
+        result = await self.loop.run_in_executor(self.executor, functools.partial(function, *args))
+        await self.drain()
+        return result
+
+    async def async_receive_exactly_into(self, view: memoryview):
+        """Fills view from self.reader"""
+        try:
+            data = await self.reader.readexactly(len(view))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            raise ClientDisconnectException('Connection closed') from e
+        view[:] = data
+        self.receive_calls += 1
+        self.bytes_received += len(data)
+
+    async def async_receive_frame(self) -> tuple:
+        """Coroutine version of receive_frame"""
+        header = memoryview(self.header_buffer)
+        await self.async_receive_exactly_into(header[:FRAME_HEADER.size])
+        frame_header = self.read_frame_header(header)
+        if frame_header is None:
+            return await self.async_receive_legacy_frame(header)
+
+        frame_type, flags, data_length, signature_length = frame_header
+        body = self.get_receive_view(data_length + signature_length)
+        await self.async_receive_exactly_into(body)
+        return frame_type, flags, body[:data_length], body[data_length:]
+
+    async def async_receive_legacy_frame(self, header: memoryview) -> tuple:
+        """Coroutine version of receive_legacy_frame"""
+        await self.async_receive_exactly_into(header[FRAME_HEADER.size:HEADER])
+        data_length = int(str(header, FORMAT))
+        await self.async_receive_exactly_into(self.get_receive_view(data_length))
+
+        await self.async_receive_exactly_into(header)
+        signature_length = int(str(header, FORMAT))
+        body = self.get_receive_view(
+            data_length + signature_length, keep=data_length)
+        await self.async_receive_exactly_into(body[data_length:])
+        return None, None, body[:data_length], body[data_length:]
+
+    async def async_receive_data(self) -> dict:
+        """Coroutine version of receive_data - the signature is checked in self.executor"""
+        return await self.run_crypto(self.open_signed_frame, await self.async_receive_frame())
+
+    async def async_recieve_encrypted_data(self, private_key: rsa.PrivateKey, return_public_key=False, return_Epk=False):
+        """Coroutine version of recieve_encrypted_data - decrypting is done in self.executor"""
+        frame = await self.async_receive_frame()
+        return await self.run_crypto(self.open_encrypted_frame, frame, private_key, return_public_key, return_Epk)
+
+    def compress_payload(self, data: dict, seralized_data: bytes) -> tuple:
+        """
+        Returns (payload, compressed) compressing seralized_data if it is worth it
+
+        Small payloads and images (which are already compressed) are left as they are
+        """
+        if (not self.compression or self.legacy_framing or len(seralized_data) < COMPRESSION_THRESHOLD
+                or data.get('is_image')):
+            return seralized_data, False
+        compressed_data = zlib.compress(seralized_data, self.compression_level)
+        if len(compressed_data) >= len(seralized_data):
+            return seralized_data, False
+        return compressed_data, True
+
+    def decompress_payload(self, payload: bytes, compressed: bool) -> bytes:
+        """Returns payload decompressed if compressed is set (refusing anything bigger than MAX_DECOMPRESSED_SIZE)"""
+        if not compressed:
+            return payload
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Compressed payload is too big or truncated")
+        return data
+
+    def new_session_secret(self) -> bytes:
+        return secrets.token_bytes(SESSION_SECRET_SIZE)
+
+    def start_session(self, secret: bytes):
+        """Protects every following client-server message with keys derived from secret"""
+        if self.legacy_framing:
+            return  # legacy packets have no frame type to mark session frames with
+        self.session = Session(secret, self.type == 'CLIENT')
+
+    def send_session_data(self, data: dict):
+        """Sends data to the other end of the session encrypted and HMAC tagged instead of using RSA"""
+        codec, flags = self.send_codec()
+        sequence = self.session.send_sequence
+        self.session.send_sequence += 1
+
+        seralized_data, compressed = self.compress_payload(
+            data, self.serialize_dict(data, codec))
+        if compressed:
+            flags |= FLAG_COMPRESSED
+        Epk = self.session.message_key(self.session.send_key, sequence)
+        encrypted_data = self.encrypt(seralized_data, Epk)
+        body = SEQUENCE.pack(sequence) + encrypted_data
+        tag = self.session.tag(self.session.send_mac_key, flags, body)
+        self.send_frame(FRAME_SESSION, body, tag, flags)
+
+    def open_session_frame(self, flags: int, body: memoryview, tag: memoryview) -> dict:
+        """Checks a session frame's tag and sequence number returning the decrypted data"""
+        if self.session is None:
+            raise SessionAuthenticationError(
+                "Recieved a session frame without a session")
+        expected_tag = self.session.tag(
+            self.session.receive_mac_key, flags, body)
+        if not hmac.compare_digest(expected_tag, tag):
+            raise SessionAuthenticationError("Session frame tag is invalid")
+        sequence = SEQUENCE.unpack_from(body)[0]
+        if sequence != self.session.receive_sequence:  # replayed, dropped or reordered
+            raise SessionAuthenticationError(
+                f"Expected session frame {self.session.receive_sequence} but got {sequence}")
+        self.session.receive_sequence += 1
+
+        Epk = self.session.message_key(self.session.receive_key, sequence)
+        seralized_data = self.decompress_payload(self.decrypt(
+            body[SEQUENCE.size:], Epk), flags & FLAG_COMPRESSED)
+        data = self.deserialize_dict(seralized_data, self.frame_codec(flags))
+        if self.type == 'SERVER' and data['type'] == 'DISCONNECT':
+            raise ClientDisconnectException('Client Disconnected')
+        return data
+
+    def new_conversation_key(self) -> ConversationKey:
+        return ConversationKey(secrets.token_hex(8), secrets.token_bytes(SESSION_SECRET_SIZE))
+
+    def save_conversation_key(self, friend_id: str, direction: str, key: ConversationKey):
+        """Called when a conversation key is added or its sequence number changes (direction is 'send' or 'recv'). Overridden by clients to store it"""
+        pass
+
+    def send_conversation_message(self, data: dict, key: ConversationKey, sender_id: str, recipient_user_id: str) -> bytes:
+        """
+        Sends data to recipient_user_id encrypted under a conversation key instead of a new RSA encrypted Epk
+
+        Returns the messages Epk
+        """
+        codec, flags = self.send_codec()
+        key.sequence += 1
+        Epk = key.message_key(key.sequence)
+        seralized_data, compressed = self.compress_payload(
+            data, self.serialize_dict(data, codec))
+        lump_data = {'encrypted_data': self.encrypt(seralized_data, Epk),
+                     'recipient': 'client',
+                     'type': data['type'],
+                     'recipient_user_id': recipient_user_id,
+                     'sender': sender_id,
+                     'key_id': key.key_id,
+                     'sequence': key.sequence}
+        if compressed:  # signed/tagged with the rest of the lump
+            lump_data['compressed'] = True
+        seralized_lump_data = self.serialize_dict(lump_data, codec)
+        seralized_signature = self.serialize_dict(
+            {'tag': key.tag(seralized_lump_data)}, codec)
+        self.send_frame(FRAME_ENCRYPTED, seralized_lump_data, seralized_signature,
+                        flags | FLAG_ROUTED, self.route_header(recipient_user_id, data['type']))
+        self.save_conversation_key(recipient_user_id, 'send', key)
+        return Epk
+
+    def open_conversation_message(self, seralized_lump_data, lump_data: dict, signature: dict, codec: str) -> tuple:
+        """
+        Checks the tag and sequence number of a conversation message returning (data, Epk)
+
+        If the key is not known the data is {'type': 'unknown_conversation_key'} with
+        the sender and key_id so the sender can be asked for a new one
+        """
+        sender_id = lump_data['sender']
+        key = self.receiving_conversation_keys.get(sender_id)
+        if key is None or key.key_id != lump_data['key_id']:
+            print(f"[+] No conversation key {lump_data['key_id']} from {sender_id}")
+            return {'type': 'unknown_conversation_key', 'sender': sender_id, 'key_id': lump_data['key_id']}, None
+        if not hmac.compare_digest(key.tag(seralized_lump_data), signature['tag']):
+            print(f"[+] Conversation message tag fail from {sender_id}")
+            return {'type': 'None'}, None
+        if lump_data['sequence'] <= key.sequence:  # replayed
+            print(f"[+] Replayed conversation message from {sender_id}")
+            return {'type': 'None'}, None
+
+        key.sequence = lump_data['sequence']
+        self.save_conversation_key(sender_id, 'recv', key)
+        Epk = key.message_key(key.sequence)
+        seralized_data = self.decompress_payload(self.decrypt(
+            lump_data['encrypted_data'], Epk), lump_data.get('compressed', False))
+        data = self.deserialize_dict(seralized_data, codec)
+        return data, Epk
+
+    def frame_codec(self, flags) -> str:
+        """Returns the codec used by a frame with flags (None for legacy packets)"""
+        if flags is not None and flags & FLAG_BINARY_CODEC:
+            return CODEC_BINARY
+        return CODEC_JSON
+
+    def send_codec(self) -> tuple:
+        """Returns (codec, frame flags) to send with, always JSON if the other end uses legacy packets"""
+        if self.legacy_framing or self.codec != CODEC_BINARY:
+            return CODEC_JSON, 0
+        return CODEC_BINARY, FLAG_BINARY_CODEC
+
+    def reads_binary(self, recipient_user_id: str) -> bool:
+        """Returns True if recipient_user_id's client is known to read binary, compressed and conversation key lumps"""
+        return self.recipient_codecs.get(recipient_user_id) == CODEC_BINARY
 
     def send_encrypted_data(self, data: dict, Epk: bytes, private_key: rsa.PrivateKey, public_key: rsa.PublicKey, recipient_public_key: rsa.PublicKey, recipient, return_message=False, *recipient_user_id):
         """
@@ -91,7 +689,16 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
         - *recipient_user_id: only needed if data is a message from client to client
         """
 
-        seralized_data = self.serialize_dict(data)
+        codec, flags = self.send_codec()
+        # relayed lumps are read by the recipient not the server, so are kept legacy unless they can read more
+        legacy_recipient = len(
+            recipient_user_id) != 0 and not self.reads_binary(recipient_user_id[0])
+        if legacy_recipient:
+            codec, flags = CODEC_JSON, 0
+            seralized_data, compressed = self.serialize_dict(data, codec), False
+        else:
+            seralized_data, compressed = self.compress_payload(
+                data, self.serialize_dict(data, codec))
         encrypted_data = self.encrypt(seralized_data, Epk)
 
         encrypted_Epk = rsa.encrypt(Epk, recipient_public_key)
@@ -100,43 +707,77 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
                      'encrypted_Epk': encrypted_Epk,
                      'recipient': recipient}
 
+        if compressed:  # only set when compressed so legacy clients never see it
+            lump_data['compressed'] = True
+
         if data['type'] == 'message':
             lump_data['type'] = 'message'
 
+        route = b''
         if len(recipient_user_id) != 0:
             lump_data['recipient_user_id'] = recipient_user_id[0]
+            route = self.route_header(recipient_user_id[0], data['type'])
+            flags |= FLAG_ROUTED
 
-        seralized_lump_data = self.serialize_dict(lump_data)
+        seralized_lump_data = self.serialize_dict(lump_data, codec)
 
         signature = self.generate_signature(
             seralized_lump_data, private_key, public_key)
 
-        seralized_signature = self.serialize_dict(signature)
+        seralized_signature = self.serialize_dict(signature, codec)
 
-        self.send_with_header(seralized_lump_data)
-        self.send_with_header(seralized_signature)
+        self.send_frame(FRAME_ENCRYPTED, seralized_lump_data,
+                        seralized_signature, flags, route)
 
         if return_message:
             return seralized_lump_data
 
     def recieve_encrypted_data(self, private_key: rsa.PrivateKey, return_public_key=False, return_Epk=False):
         """Recieves encrypted data from self.client returning data + others depending on arguments"""
-        seralized_lump_data = self.receive_data_with_header()
-        seralized_signature = self.receive_data_with_header()
+        return self.open_encrypted_frame(self.receive_frame(), private_key, return_public_key, return_Epk)
+
+    def open_encrypted_frame(self, frame: tuple, private_key: rsa.PrivateKey, return_public_key=False, return_Epk=False):
+        """Decrypts a frame from receive_frame returning the same as recieve_encrypted_data"""
+        frame_type, flags, seralized_lump_data, seralized_signature = frame
+        codec = self.frame_codec(flags)
+
+        if frame_type == FRAME_SESSION:  # from the other end of the session so there is no Epk or signature
+            data = self.open_session_frame(
+                flags, seralized_lump_data, seralized_signature)
+            if return_public_key or return_Epk:
+                return True, data, None
+            return True, data
+
+        if flags is not None and flags & FLAG_ROUTED:
+            kind, recipient_user_id, route_length = self.read_route(
+                seralized_lump_data)
+            if self.type == 'SERVER':
+                # forwarded without decoding - the views are only valid until the next frame is recieved
+                return False, seralized_lump_data, seralized_signature, flags, recipient_user_id
+            seralized_lump_data = seralized_lump_data[route_length:]
 
         if seralized_lump_data != 0 and seralized_signature != 0:
-            lump_data = self.deserialize_dict(seralized_lump_data)
-            signature = self.deserialize_dict(seralized_signature)
+            lump_data = self.deserialize_dict(seralized_lump_data, codec)
+            signature = self.deserialize_dict(seralized_signature, codec)
 
             # If data should NOT be forwarded
             if (self.type == 'SERVER' and lump_data['recipient'] == 'server') or (self.type == 'CLIENT' and lump_data['recipient'] == 'client'):
+                if 'key_id' in lump_data:  # encrypted with a conversation key rather than an Epk
+                    data, Epk = self.open_conversation_message(
+                        seralized_lump_data, lump_data, signature, codec)
+                    if return_public_key:
+                        return True, data, None  # the tag already shows it came from the friend
+                    elif return_Epk:
+                        return True, data, Epk
+                    return True, data
                 if self.validate_signature(seralized_lump_data, signature):
                     encrypted_Epk = lump_data['encrypted_Epk']
-                    Epk = rsa.decrypt(encrypted_Epk, private_key)
+                    Epk = self.rsa_decrypt(encrypted_Epk, private_key)
 
-                    seralized_decrypted_data = self.decrypt(
-                        lump_data['encrypted_data'], Epk)
-                    data = self.deserialize_dict(seralized_decrypted_data)
+                    seralized_decrypted_data = self.decompress_payload(self.decrypt(
+                        lump_data['encrypted_data'], Epk), lump_data.get('compressed', False))
+                    data = self.deserialize_dict(
+                        seralized_decrypted_data, codec)
 
                     if self.type == 'SERVER' and data['type'] == 'DISCONNECT':
                         raise ClientDisconnectException('Client Disconnected')
@@ -151,13 +792,16 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
                 else:
                     return True, data  # data is for either
             else:
-                # data is for server to forward to another client
-                return False, seralized_lump_data, seralized_signature
+                # data is for server to forward to another client (from a client without routes)
+                # flags are kept so the recipient knows which codec to read it with
+                return False, seralized_lump_data, seralized_signature, flags or 0, lump_data['recipient_user_id']
 
-    def forward_data(self, seralized_data, seralized_signature):
+    def forward_data(self, seralized_data, seralized_signature, flags: int = 0):
         """Sends data without signature or encryption"""
-        self.send_with_header(seralized_data)
-        self.send_with_header(seralized_signature)
+        if self.legacy_framing and flags & FLAG_ROUTED:
+            seralized_data = seralized_data[self.read_route(seralized_data)[2]:]
+        self.send_frame(FRAME_ENCRYPTED, seralized_data,
+                        seralized_signature, flags)
 
     def send_data(self, data: dict, private_key: rsa.PrivateKey, public_key: rsa.PublicKey):
         """
@@ -169,25 +813,33 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
         - public_key: SENDERS public_key
         """
 
-        seralized_data = self.serialize_dict(data)
+        codec, flags = self.send_codec()
+        seralized_data = self.serialize_dict(data, codec)
 
         signature = self.generate_signature(
             seralized_data, private_key, public_key)
 
-        seralized_signature = self.serialize_dict(signature)
+        seralized_signature = self.serialize_dict(signature, codec)
 
-        self.send_with_header(seralized_data)
-        self.send_with_header(seralized_signature)
+        self.send_frame(FRAME_SIGNED, seralized_data,
+                        seralized_signature, flags)
 
     def receive_data(self) -> dict:
         """Receives data from self.client deserializing it before returning"""
-        json_data = self.receive_data_with_header()
-        json_signature = self.receive_data_with_header()
+        return self.open_signed_frame(self.receive_frame())
+
+    def open_signed_frame(self, frame: tuple) -> dict:
+        """Checks the signature of a frame from receive_frame returning its data"""
+        frame_type, flags, json_data, json_signature = frame
+        codec = self.frame_codec(flags)
 
-        signature = self.deserialize_dict(json_signature)
+        if frame_type == FRAME_SESSION:
+            return self.open_session_frame(flags, json_data, json_signature)
+
+        signature = self.deserialize_dict(json_signature, codec)
 
         if json_data != 0 and json_signature != 0 and self.validate_signature(json_data, signature):
-            data = self.deserialize_dict(json_data)
+            data = self.deserialize_dict(json_data, codec)
             if self.type == 'SERVER' and data['type'] == 'DISCONNECT':
                 raise ClientDisconnectException('Client Disconnected')
             else:
@@ -195,8 +847,14 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
         else:
             print("[+] Signature Invalid/Recieved Empty Mesage")
 
-    def serialize_dict(self, data: dict) -> bytes:
-        """Seralizes a dictionary and encodes it in a JSON format then encodes it """
+    def serialize_dict(self, data: dict, codec: str = CODEC_JSON) -> bytes:
+        """Seralizes a dictionary with codec (JSON by default) returning the bytes"""
+        # all dicts need 'type' in for sending and recieving purposes in client and server code
+        if 'type' not in data:
+            data['type'] = 'None'
+        if codec == CODEC_BINARY:
+            return self.binary_encode(data)
+
         obj_mapping = []  # contains the keys in the dict where the value was an object
         bytes_mapping = []  # contains the keys in the dict where the value was bytes
         for key, value in data.items():
@@ -207,19 +865,18 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
                 data[key] = self.serialize_bytes(value)
                 bytes_mapping.append(key)
 
-        # all dicts need 'type' in for sending and recieving purposes in client and server code
-        if 'type' not in data:
-            data['type'] = 'None'
-
         data['obj_mapping'] = obj_mapping
         data['bytes_mapping'] = bytes_mapping
         data = json.dumps(data)
         data = data.encode(FORMAT)
         return data
 
-    def deserialize_dict(self, data: bytes) -> dict:
+    def deserialize_dict(self, data: bytes, codec: str = CODEC_JSON) -> dict:
         """Turns serialised bytes into a dictionary also deserializing any objects or bytes too"""
-        data = data.decode(FORMAT)
+        if codec == CODEC_BINARY:
+            return self.binary_decode(data)
+
+        data = str(data, FORMAT)  # works for memoryviews of the receive buffer too
         data = json.loads(data)
         for key, value in data.items():
             if key in data['obj_mapping']:
@@ -228,6 +885,111 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
                 data[key] = self.deserialize_bytes(value)
         return data
 
+    def binary_encode(self, value) -> bytes:
+        """Returns value encoded with the binary codec"""
+        output = bytearray()
+        self.binary_encode_into(value, output)
+        return bytes(output)
+
+    def binary_encode_into(self, value, output: bytearray):
+        """Appends value to output as a tag followed by its contents (nested lists and dicts included)"""
+        if value is None:
+            output += TAG.pack(TAG_NONE)
+        elif value is True or value is False:
+            output += TAG.pack(TAG_TRUE if value else TAG_FALSE)
+        elif isinstance(value, int):
+            if -2**63 <= value < 2**63:
+                output += TAG.pack(TAG_INT)
+                output += INT.pack(value)
+            else:
+                length = (value.bit_length() + 8) // 8  # +8 leaves room for the sign bit
+                output += TAG.pack(TAG_BIG_INT)
+                output += LENGTH.pack(length)
+                output += value.to_bytes(length, 'big', signed=True)
+        elif isinstance(value, float):
+            output += TAG.pack(TAG_FLOAT)
+            output += FLOAT.pack(value)
+        elif isinstance(value, str):
+            encoded = value.encode(FORMAT)
+            output += TAG.pack(TAG_STR)
+            output += LENGTH.pack(len(encoded))
+            output += encoded
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            output += TAG.pack(TAG_BYTES)
+            output += LENGTH.pack(len(value))
+            output += value
+        elif isinstance(value, (list, tuple)):
+            output += TAG.pack(TAG_LIST)
+            output += LENGTH.pack(len(value))
+            for item in value:
+                self.binary_encode_into(item, output)
+        elif isinstance(value, dict):
+            output += TAG.pack(TAG_DICT)
+            output += LENGTH.pack(len(value))
+            for key, item in value.items():
+                self.binary_encode_into(key, output)
+                self.binary_encode_into(item, output)
+        elif isinstance(value, rsa.PublicKey):
+            der = public_keys.public_key_to_der(value)
+            output += TAG.pack(TAG_PUBLIC_KEY)
+            output += LENGTH.pack(len(der))
+            output += der
+        else:
+            raise TypeError(
+                f"Binary codec can't encode {type(value).__name__}")
+
+    def binary_decode(self, data) -> object:
+        """Returns the value encoded in data by binary_encode (data can be a memoryview of the receive buffer)"""
+        view = memoryview(data).cast('B')
+        value, offset = self.binary_decode_from(view, 0)
+        if offset != len(view):
+            raise ValueError(
+                f"{len(view) - offset} bytes left over after binary decoding")
+        return value
+
+    def binary_decode_from(self, view: memoryview, offset: int) -> tuple:
+        """Decodes the value starting at offset returning (value, offset after it)"""
+        tag = view[offset]
+        offset += 1
+        if tag == TAG_NONE:
+            return None, offset
+        elif tag == TAG_FALSE:
+            return False, offset
+        elif tag == TAG_TRUE:
+            return True, offset
+        elif tag == TAG_INT:
+            return INT.unpack_from(view, offset)[0], offset + INT.size
+        elif tag == TAG_FLOAT:
+            return FLOAT.unpack_from(view, offset)[0], offset + FLOAT.size
+
+        length = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        if tag == TAG_LIST:
+            items = []
+            for _ in range(length):
+                item, offset = self.binary_decode_from(view, offset)
+                items.append(item)
+            return items, offset
+        elif tag == TAG_DICT:
+            items = {}
+            for _ in range(length):
+                key, offset = self.binary_decode_from(view, offset)
+                items[key], offset = self.binary_decode_from(view, offset)
+            return items, offset
+
+        end = offset + length
+        if end > len(view):
+            raise ValueError("Binary encoded value is truncated")
+        if tag == TAG_STR:
+            return str(view[offset:end], FORMAT), end
+        elif tag == TAG_BYTES:
+            return bytes(view[offset:end]), end
+        elif tag == TAG_BIG_INT:
+            return int.from_bytes(view[offset:end], 'big', signed=True), end
+        elif tag == TAG_PUBLIC_KEY:
+            return public_keys.public_key_from_der(view[offset:end]), end
+        raise ValueError(f"Unknown binary codec tag {tag}")
+
     def serialize_bytes(self, data: bytes) -> str:
         """Returns bytes encoded to base64"""
         b64 = base64.b64encode(data)
@@ -245,7 +1007,16 @@ class BaseClass(aes.Encrypt, aes.Decrypt):
         return string_of_object
 
     def deserialize_object(self, serialized_object: str) -> object:
-        """Returns an python object of the serialised_object using pickle"""
+        """
+        Returns the rsa.PublicKey in serialised_object
+
+        Only public keys are unpickled as the object may have come from the other end of a connection
+        """
+        pickled_object = self.deserialize_bytes(serialized_object)
+        return public_keys.LegacyKeyUnpickler(io.BytesIO(pickled_object)).load()
+
+    def deserialize_trusted_object(self, serialized_object: str) -> object:
+        """Returns any python object of the serialised_object using pickle - only for data written locally"""
         pickled_object = self.deserialize_bytes(serialized_object)
         unpickled_object = pickle.loads(pickled_object)
         return unpickled_object
@@ -1,17 +1,25 @@
 # Cryptography imports
 import secrets
 import rsa
+import class_based_aes as aes
 
 # socket imports
 from neat_networking_protocols import BaseClass
+from neat_networking_protocols import USE_SESSIONS
+from neat_networking_protocols import ConversationKey
+from neat_networking_protocols import CONVERSATION_KEY_MAX_MESSAGES
+from neat_networking_protocols import CODEC_JSON
 # from netrworkingProtocols import BaseClass
 import socket
 
 # file handling and database imports
 from tkinter import filedialog
 import serverDatabase
+import public_keys
 from PIL import Image
 import os
+import io
+import shutil
 
 # hashing imports
 from hashlib import md5  # used in secret keeping NOT for password hashing
@@ -49,6 +57,7 @@ class Client(BaseClass):
         self.friend_request_list = None
         self.pending_friend_list = None
         self.current_message_history = []
+        self.requested_conversation_keys = set()  # (friend_id, key_id) already asked for a new key
 
         self.connected = False
         self.logged_in = False
@@ -104,6 +113,8 @@ class Client(BaseClass):
         """Creates and or connects to database in self.user_path"""
         db_path = os.path.join(self.user_path, 'user_data.db')
         self.sql = serverDatabase.Database(db_path)
+        self.sql.client_tables()  # adds tables missing from older databases
+        self.sql.migrate_public_keys('friendships')
 
     def close_db_connection(self):
         if self.logged_in:
@@ -112,12 +123,18 @@ class Client(BaseClass):
 
     def send_data_to_server(self, data):
         """Sends data to server autofilling public and private key parameter"""
+        if self.session is not None:
+            self.send_session_data(data)
+            return
         self.send_data(data,
                        self.private_key, self.public_key)
 
     def send_encrypted_data_to_server(self, data: dict):
-        """Creates Epk and sends encrypted data to server"""
+        """Creates Epk and sends encrypted data to server (or uses the session if there is one)"""
         print(f"[SENDING ENCRYPTED DATA TO SERVER] {data}")
+        if self.session is not None:
+            self.send_session_data(data)
+            return
         Epk = secrets.token_bytes(16)
 
         self.send_encrypted_data(
@@ -130,19 +147,30 @@ class Client(BaseClass):
     def send_encrypted_data_to_recipient(self, data, recipient_user_id, return_confg_data=False):
         """Creates Epk, gets recipients private key and sends data to server to forward to recipient"""
         print(f"[SENDING ENCRYTED DATA TO {recipient_user_id}] {data}")
-        Epk = secrets.token_bytes(16)
-
         data['sender'] = self.user_id
         data['public_key'] = self.public_key
 
+        # messages use the conversation key so need no RSA, once the recipient is known to understand them
+        if data['type'] == 'message' and self.reads_binary(recipient_user_id):
+            key = self.get_sending_conversation_key(recipient_user_id)
+            Epk = self.send_conversation_message(
+                data, key, self.user_id, recipient_user_id)
+            if return_confg_data:
+                return Epk
+            return
+
+        Epk = secrets.token_bytes(16)
+
         # getting recipient public key from server
         self.send_encrypted_data_to_server(
             {'type': 'get_recipient_public_key',
              'recipient_user_id': recipient_user_id}
         )
-        seralised_recipinet_public_key = self.recieve_encrypted_data_from_server()[
-            'recipient_public_key']
-        recipinet_public_key = self.deserialize_object(
+        reply = self.recieve_encrypted_data_from_server()
+        seralised_recipinet_public_key = reply['recipient_public_key']
+        self.recipient_codecs[recipient_user_id] = reply.get(
+            'recipient_codec', CODEC_JSON)
+        recipinet_public_key = public_keys.decode_public_key(
             seralised_recipinet_public_key)
 
         encrypted_message = self.send_encrypted_data(
@@ -151,6 +179,88 @@ class Client(BaseClass):
         if return_confg_data:
             return Epk
 
+    # --------CONVERSATION KEYS----------
+
+    def get_sending_conversation_key(self, friend_id: str):
+        """Returns the key for sending messages to friend_id, sending them a new one if it needs rotating"""
+        key = self.sending_conversation_keys.get(friend_id)
+        if key is None or key.needs_rotating():
+            key = self.new_conversation_key()
+            print(f"[NEW CONVERSATION KEY FOR {friend_id}] {key.key_id}")
+            self.send_encrypted_data_to_recipient(
+                {'type': 'conversation_key',
+                 'key_id': key.key_id,
+                 'conversation_key': key.secret}, friend_id)
+            self.sending_conversation_keys[friend_id] = key
+            self.store_conversation_key(friend_id, 'send', key)
+        return key
+
+    def add_receiving_conversation_key(self, friend_id: str, key_id: str, secret: bytes):
+        """
+        Replaces friend_id's key - messages arrive in order so the old one is not needed again
+
+        A key_id already received is ignored so a replayed envelope can't reset the
+        key's sequence and let old messages be accepted again
+        """
+        current_key = self.receiving_conversation_keys.get(friend_id)
+        if (current_key is not None and current_key.key_id == key_id) or \
+                self.sql.check_received_conversation_key_id(friend_id, key_id):
+            print(f"[+] Ignoring replayed conversation key {key_id} from {friend_id}")
+            return
+        key = ConversationKey(key_id, secret)
+        self.receiving_conversation_keys[friend_id] = key
+        self.store_conversation_key(friend_id, 'recv', key)
+        self.sql.add_received_conversation_key_id(friend_id, key_id)
+
+    def request_conversation_key(self, friend_id: str, key_id: str):
+        """
+        Asks friend_id to send a new conversation key after a message arrived under key_id which is not known
+
+        Happens if the key's envelope was lost or failed its signature check, or the
+        database was reset. Only asked once for each key_id
+        """
+        if (friend_id, key_id) in self.requested_conversation_keys:
+            return
+        self.requested_conversation_keys.add((friend_id, key_id))
+        seralized_public_key = self.sql.get_friend_public_key(friend_id)
+        if seralized_public_key is None:  # not a friend
+            return
+        print(f"[REQUESTING CONVERSATION KEY FROM {friend_id}] instead of {key_id}")
+        # friends public key is stored so no lookup is needed while the server is forwarding data to us
+        self.send_encrypted_data(
+            {'type': 'conversation_key_request', 'key_id': key_id,
+             'sender': self.user_id, 'public_key': self.public_key},
+            secrets.token_bytes(16), self.private_key, self.public_key,
+            public_keys.decode_public_key(seralized_public_key), 'client', False, friend_id)
+
+    def expire_sending_conversation_key(self, friend_id: str, key_id: str):
+        """Makes the next message to friend_id send a new key if key_id is the current one"""
+        key = self.sending_conversation_keys.get(friend_id)
+        if key is None or key.key_id != key_id:  # already rotated
+            return
+        print(f"[CONVERSATION KEY {key_id} NOT KNOWN BY {friend_id}]")
+        key.sequence = max(key.sequence, CONVERSATION_KEY_MAX_MESSAGES)
+        self.save_conversation_key(friend_id, 'send', key)
+
+    def store_conversation_key(self, friend_id: str, direction: str, key):
+        """Stores key in the database encrypted with self.master_key"""
+        self.sql.store_conversation_key(
+            friend_id, direction, key.key_id, self.encrypt(key.secret, self.master_key), key.created, key.sequence)
+
+    def save_conversation_key(self, friend_id: str, direction: str, key):
+        self.sql.update_conversation_key_sequence(
+            friend_id, direction, key.key_id, key.sequence)
+
+    def load_conversation_keys(self):
+        """Loads the stored conversation keys decrypting them with self.master_key"""
+        for friend_id, direction, key_id, encrypted_key, created, sequence in self.sql.get_conversation_keys():
+            key = ConversationKey(key_id, self.decrypt(
+                encrypted_key, self.master_key), created, sequence)
+            if direction == 'send':
+                self.sending_conversation_keys[friend_id] = key
+            else:
+                self.receiving_conversation_keys[friend_id] = key
+
     # --------CREATE/LOGIN/DELETE ACCOUNT ----------
 
     def login(self, user_id: str, password: str):
@@ -169,6 +279,7 @@ class Client(BaseClass):
             self.user_images_path = os.path.join(self.user_path, 'images')
             self.connect_to_database()
             self.get_keys_from_file()
+            self.load_conversation_keys()
             self.swap_public_keys()
         print(f"[LOGIN {login}]")
         return login
@@ -281,13 +392,17 @@ class Client(BaseClass):
             key_data['master_key'], self.password_hash)
         seralized_private_key = self.decrypt(
             key_data['private_key'], self.password_hash).decode()
-        self.private_key = self.deserialize_object(seralized_private_key)
+        self.private_key = self.deserialize_trusted_object(seralized_private_key)
 
     def swap_public_keys(self):
         """sends public key to server and recieves servers public key"""
         self.send_data_to_server(
-            {'recipient': 'server', 'public_key': self.public_key})
-        self.server_public_key = self.receive_data()['public_key']
+            {'recipient': 'server', 'public_key': self.public_key, 'session': USE_SESSIONS, 'compression': self.compression})
+        server_data = self.receive_data()
+        self.server_public_key = server_data['public_key']
+        if 'session_key' in server_data:  # servers that support sessions send one encrypted to the new public key
+            self.start_session(rsa.decrypt(
+                server_data['session_key'], self.private_key))
 
     # -------GETTING FRIENDS LISTS-------
 
@@ -347,7 +462,7 @@ class Client(BaseClass):
                 recieved_data = total_data[1]
                 Epk = total_data[2]
                 if recieved_data['type'] == 'friend_request':
-                    seralized_public_key = self.serialize_object(
+                    seralized_public_key = public_keys.encode_public_key(
                         recieved_data['public_key'])
                     self.sql.add_new_friend_request(
                         recieved_data['sender'], recieved_data['screen_name'], seralized_public_key, recieved_data['sender'])
@@ -380,6 +495,15 @@ class Client(BaseClass):
                     friend_id = recieved_data['sender']
                     self.sql.friend_deleted_account(
                         friend_id, account_deletion_name)
+                elif recieved_data['type'] == 'conversation_key':
+                    self.add_receiving_conversation_key(
+                        recieved_data['sender'], recieved_data['key_id'], recieved_data['conversation_key'])
+                elif recieved_data['type'] == 'unknown_conversation_key':
+                    self.request_conversation_key(
+                        recieved_data['sender'], recieved_data['key_id'])
+                elif recieved_data['type'] == 'conversation_key_request':
+                    self.expire_sending_conversation_key(
+                        recieved_data['sender'], recieved_data['key_id'])
                 elif recieved_data['type'] == 'message':
                     self.handel_recieved_message(recieved_data, Epk)
 
@@ -461,12 +585,19 @@ class Client(BaseClass):
         return self.sql.get_message_list(friend_id)
 
     def decrypt_message_history(self, friend_id: str):
-        self.current_message_history = []
+        """Sets self.current_message_history decrypting all the messages with friend_id in two batches"""
         encrypted_message_history = self.get_message_history(friend_id)
 
-        for message_details in encrypted_message_history:
-            values = self.decrypt_message(message_details)
-            self.current_message_history.append(values[:])
+        # all Epks first as each message needs its Epk to be decrypted
+        Epks = self.decrypt_batch(
+            [(message_details[0], self.master_key) for message_details in encrypted_message_history])
+        decrypted_messages = self.decrypt_batch(
+            [(message_details[1], Epk) for message_details, Epk in zip(encrypted_message_history, Epks)])
+
+        # (decrypted_message, date, time, from_me, is_image)
+        self.current_message_history = [
+            (decrypted_message.decode(), *message_details[2:])
+            for message_details, decrypted_message in zip(encrypted_message_history, decrypted_messages)]
 
     # -------Add Friend Page fuctions-------
 
@@ -537,19 +668,45 @@ class Client(BaseClass):
         Returns stored image path
         """
         image_name_and_format = image_path.split('/')[-1]
+        new_image_path = self.find_sutable_image_path(image_name_and_format)
 
-        image_file = open(image_path, 'rb')
-
-        image_data = image_file.read()
-        return self.store_image_to_files(image_name_and_format, image_data)
+        # copied a chunk at a time so the whole image is never held in memory
+        # attachments always use one process so the GUI never starts a process pool
+        with open(image_path, 'rb') as image_file, open(new_image_path, 'wb') as new_image_file:
+            with aes.EncryptedAttachmentWriter(new_image_file, self.master_key, max_workers=1) as encrypted_image_file:
+                shutil.copyfileobj(
+                    image_file, encrypted_image_file, aes.CHUNK_SIZE)
+        return new_image_path
 
     def store_image_to_files(self, image_name_and_format, image_data):
-        """Stores image to self.user_images_path"""
+        """Stores image to self.user_images_path encrypted with self.master_key"""
         new_image_path = self.find_sutable_image_path(image_name_and_format)
-        new_image_file = open(new_image_path, 'wb')
-        new_image_file.write(image_data)
+        with open(new_image_path, 'wb') as new_image_file:
+            with aes.EncryptedAttachmentWriter(new_image_file, self.master_key, max_workers=1) as encrypted_image_file:
+                encrypted_image_file.write(image_data)
         return new_image_path
 
+    def open_stored_image(self, image_path: str):
+        """
+        Returns a seekable file object for the image at image_path. 
+
+        Stored images are decrypted as they are read so only the parts 
+        actually read get decrypted. Unencrypted images (older stored images 
+        and images about to be sent) are opened as they are
+        """
+        image_file = open(image_path, 'rb')
+        if not aes.is_encrypted_attachment(image_file):
+            return image_file
+        return io.BufferedReader(aes.EncryptedAttachmentReader(image_file, self.master_key, closefd=True, max_workers=1))
+
+    def read_stored_image_range(self, image_path: str, start: int, end: int) -> bytes:
+        """Returns bytes start to end of the image at image_path without decrypting the rest of it"""
+        with open(image_path, 'rb') as image_file:
+            if not aes.is_encrypted_attachment(image_file):
+                image_file.seek(start)
+                return image_file.read(max(end - start, 0))
+            return aes.EncryptedAttachmentReader(image_file, self.master_key, max_workers=1).read_range(start, end)
+
     def find_sutable_image_path(self, image_name_and_format: str):
         """
         Finds sutable image name by adding (i) if there are duplicates
@@ -1,6 +1,9 @@
 # socket imports
 from neat_networking_protocols import BaseClass
 from neat_networking_protocols import ClientDisconnectException
+from neat_networking_protocols import SessionAuthenticationError
+from neat_networking_protocols import CODEC_JSON
+from neat_networking_protocols import CODEC_BINARY
 # from netrworkingProtocols import BaseClass
 # from netrworkingProtocols import ClientDisconnectException
 import socket
@@ -16,35 +19,128 @@ import hashlib
 import keyring
 
 import threading
+from collections import deque, OrderedDict
+import time
+import asyncio
+import os
 import serverDatabase
+import public_keys
+from crypto_pool import CryptoPool
 
 HEADER = 2048  # make bigger if needed
 PORT = 65432  # TCP/UDP packets
 
 SERVER = socket.gethostbyname(socket.gethostname())
+# 'threads' runs a thread per connection, 'asyncio' runs every connection on one event loop
+SERVER_MODE = os.environ.get('NEAT_SERVER_MODE', 'threads')
+# processes used for RSA (and pure python AES) - 0 does it on the connections thread instead
+CRYPTO_PROCESSES = int(os.environ.get(
+    'NEAT_CRYPTO_PROCESSES', os.cpu_count() or 1))
+# messages for offline users are stored in the database with the newest for each user also kept in memory
+QUEUE_MEMORY_BUDGET = 32 * 1024 * 1024  # bytes of queued messages kept in memory
+HOT_TAIL_SIZE = 64  # messages kept in memory for each user
+MESSAGE_TTL = 30 * 24 * 60 * 60  # seconds before an undelivered message is deleted
+EVICTION_INTERVAL = 60  # seconds between deleting expired messages
+DELIVERY_BATCH_SIZE = 100  # queued messages read at once when a user reconnects
+# asyncio mode - bytes waiting to be sent to a user before messages for them are queued instead
+FORWARD_HIGH_WATER = 4 * 1024 * 1024
+FORWARD_DRAIN_TIMEOUT = 10  # seconds a sender waits for a slow recipient to catch up
 ADDR = (SERVER, PORT)
 FORMAT = 'utf-8'
 
-active_clients = []
-logged_in_clients = []
-server_public_key, server_private_key = rsa.newkeys(512)
+# set by setup_server so crypto pool workers (which import this module when spawned) don't make them
+server_public_key, server_private_key = None, None
+sql = None
+message_queue = None
+crypto_pool = None  # set by start_crypto_pool
 
 database = r"C:\Users\orank\OneDrive\Desktop\Computer Science\A-level NEA\OrganisedServerCode\serverDB.db"
-sql = serverDatabase.Database(database)
-sql.server_tables()
+
+
+class OnlineUsers():
+    """
+    Every connected UserHandler with an index of the logged in ones by user id
+
+    All access is under one lock so connection threads (or the event loop and
+    its crypto threads) can use it at the same time
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__connections = set()
+        self.__users = {}  # client_user_id -> UserHandler
+        self.__recievers = set()  # user ids that can be sent messages right now
+
+    def add_connection(self, handler):
+        with self.__lock:
+            self.__connections.add(handler)
+
+    def remove_connection(self, handler):
+        """Removes handler and logs its user out"""
+        with self.__lock:
+            self.__connections.discard(handler)
+            user_id = handler.client_user_id
+            if self.__users.get(user_id) is handler:
+                del self.__users[user_id]
+                self.__recievers.discard(user_id)
+
+    def login(self, user_id: str, handler) -> bool:
+        """Registers handler as user_id returning False if user_id is already online"""
+        with self.__lock:
+            if self.__users.get(user_id, handler) is not handler:
+                return False
+            self.__users[user_id] = handler
+            return True
+
+    def set_can_recieve_msg(self, user_id: str, handler, can_recieve_msg: bool):
+        with self.__lock:
+            if self.__users.get(user_id) is not handler:
+                return
+            if can_recieve_msg:
+                self.__recievers.add(user_id)
+            else:
+                self.__recievers.discard(user_id)
+
+    def is_online(self, user_id: str) -> bool:
+        with self.__lock:
+            return user_id in self.__users
+
+    def get(self, user_id: str):
+        """Returns the handler for user_id or None if they are not online"""
+        with self.__lock:
+            return self.__users.get(user_id)
+
+    def get_reciever(self, user_id: str):
+        """Returns the handler for user_id if they can be sent messages right now, otherwise None"""
+        with self.__lock:
+            if user_id in self.__recievers:
+                return self.__users[user_id]
+            return None
+
+    def snapshot(self) -> list:
+        """Returns a copy of every connection that is safe to iterate over"""
+        with self.__lock:
+            return list(self.__connections)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__connections)
+
+
+online_users = OnlineUsers()
 
 
 class UserHandler(BaseClass):
     def __init__(self, type: str, client, addr):
         super().__init__(type, client, addr)
 
-        active_clients.append(self)
         self.client_public_key = None
         self.client_user_id = None
         self.can_recieve_msg = False
+        online_users.add_connection(self)
 
         print(f"\n[NEW CONNECTION] {self.addr[0], self.addr[1]} connected.")
-        print(f"[TOTAL CONNECTIONS] {len(active_clients)}\n")
+        print(f"[TOTAL CONNECTIONS] {len(online_users)}\n")
 
     def get_name(self):
         """Returns ip, port and client userID"""
@@ -52,21 +148,66 @@ class UserHandler(BaseClass):
 
     def handel_disconnect(self):
         """Removes self from list of active clients and closes connection"""
-        active_clients.remove(self)
-        self.client.close()
+        online_users.remove_connection(self)
+        self.close_connection()
         print(
             f'[CLIENT DISCONNECTED] {self.addr[0], self.addr[1], self.client_user_id}')
-        print(f"[TOTAL CONNECTIONS] {len(active_clients)}\n")
+        print(f"[TOTAL CONNECTIONS] {len(online_users)}")
+        if crypto_pool is not None:
+            print(f"[CRYPTO POOL] {crypto_pool.metrics()}")
+        print()
+
+    def close_connection(self):
+        self.client.close()
+
+    # ------CRYPTO (done in crypto_pool if there is one)------
+
+    def rsa_decrypt(self, cipher_text: bytes, private_key: rsa.PrivateKey) -> bytes:
+        if crypto_pool is None or private_key is not server_private_key:
+            return super().rsa_decrypt(cipher_text, private_key)
+        return crypto_pool.rsa_decrypt(cipher_text)
+
+    def generate_signature(self, seralized_data: bytes, private_key, public_key) -> dict[str, bytes]:
+        if crypto_pool is None or private_key is not server_private_key:
+            return super().generate_signature(seralized_data, private_key, public_key)
+        return {'signature': crypto_pool.rsa_sign(seralized_data), 'public_key': public_key}
+
+    def validate_signature(self, seralized_data, deseralized_signature) -> bool:
+        if crypto_pool is None:
+            return super().validate_signature(seralized_data, deseralized_signature)
+        # a malformed signature fails validation like in _rsa_verify rather than dropping the connection
+        try:
+            signature = deseralized_signature['signature']
+            public_key = deseralized_signature['public_key']
+            return crypto_pool.rsa_verify(seralized_data, signature, public_key)
+        except:
+            return False
+
+    def encrypt(self, plain_text: bytes, key: bytes) -> bytes:
+        if crypto_pool is None or not crypto_pool.should_offload_aes(plain_text):
+            return super().encrypt(plain_text, key)
+        return crypto_pool.aes_encrypt(plain_text, key)
+
+    def decrypt(self, cipher_text: bytes, key: bytes) -> bytes:
+        if crypto_pool is None or not crypto_pool.should_offload_aes(cipher_text):
+            return super().decrypt(cipher_text, key)
+        return crypto_pool.aes_decrypt(cipher_text, key)
 
     # ------SENDING AND RECEIVING DATA------
 
     def send_data_to_client(self, data: dict):
         """Sends data to client autofilling public and private key arguments"""
+        if self.session is not None:
+            self.send_session_data(data)
+            return
         self.send_data(data,
                        server_private_key, server_public_key)
 
     def send_encrypted_data_to_client(self, data: dict):
-        """Sends encrypted data to client autofilling nessesary arguments"""
+        """Sends encrypted data to client autofilling nessesary arguments (or uses the session if there is one)"""
+        if self.session is not None:
+            self.send_session_data(data)
+            return
         Epk = secrets.token_bytes(16)  # Epk is unique to each new message
 
         self.send_encrypted_data(
@@ -91,10 +232,23 @@ class UserHandler(BaseClass):
         """Swaps public keys with the client setting self.client_public_key in the process"""
         print(
             f"[PUBLIC KEY SWAP] Swapping public keys with {self.get_name()}")
-        self.client_public_key = self.receive_data()['public_key']
-
-        self.send_data_to_client(
-            {'recipient': 'client', 'public_key': server_public_key})
+        self.reply_to_public_key_swap(self.receive_data())
+
+    def reply_to_public_key_swap(self, client_data: dict):
+        """Stores the clients public key and sends the servers back (with a session key if the client asked for one)"""
+        self.client_public_key = client_data['public_key']
+        self.compression = bool(client_data.get('compression'))
+
+        reply = {'recipient': 'client', 'public_key': server_public_key}
+        session_secret = None
+        if client_data.get('session') and not self.legacy_framing:
+            # only the holder of the clients private key can read the session secret
+            session_secret = self.new_session_secret()
+            reply['session_key'] = rsa.encrypt(
+                session_secret, self.client_public_key)
+        self.send_data_to_client(reply)
+        if session_secret is not None:
+            self.start_session(session_secret)
 
         print(f"[PUBLIC KEY SWAP FINISHED] with {self.get_name()}\n")
 
@@ -116,7 +270,10 @@ class UserHandler(BaseClass):
 
     def handel_login(self) -> bool:
         """Handels clients login attempt"""
-        login_details = self.recieve_encrypted_data_from_client()
+        return self.reply_to_login(self.recieve_encrypted_data_from_client())
+
+    def reply_to_login(self, login_details: dict) -> bool:
+        """Checks login_details and tells the client if they were valid returning the same"""
         user_exists = sql.check_user_id_exists(
             login_details['user_id'])
 
@@ -128,8 +285,11 @@ class UserHandler(BaseClass):
             valid_password = self.validate_login_info(
                 login_details['user_id'], login_details['password'])
 
-        if valid_password:
+        # registering checks again so two logins to the same account at once can't both work
+        if valid_password and online_users.login(login_details['user_id'], self):
             self.client_user_id = login_details['user_id']
+        else:
+            valid_password = False
 
         self.send_encrypted_data_to_client(
             {'recipient': 'CLIENT', 'valid_password': valid_password})
@@ -141,38 +301,45 @@ class UserHandler(BaseClass):
 
         details = self.recieve_encrypted_data_from_client()
 
+        if not self.reply_to_user_id_check(details):  # if user id not taken
+            account_created = self.create_account(
+                self.recieve_encrypted_data_from_client())
+        return account_created
+
+    def reply_to_user_id_check(self, details: dict) -> bool:
+        """Tells the client if the user id it wants is already used returning the same"""
         user_id_already_used = sql.check_user_id_exists(details['user_id'])
 
         self.send_encrypted_data_to_client(
             {'recipient': 'CLIENT', 'user_id_already_used': user_id_already_used})
+        return user_id_already_used
 
-        if not user_id_already_used:  # if user id not taken
-            # Creating account
-            try:
-                user_account_details = self.recieve_encrypted_data_from_client()
-                account_created = self.store_user_login_details(
-                    user_account_details['user_id'], user_account_details['screen_name'], user_account_details['password'])
-            except Exception as e:
-                print(e)
-            finally:
-                self.send_encrypted_data_to_client(
-                    {'recipient': 'CLIENT', 'account created': account_created})
-                self.client_user_id = user_account_details['user_id']
-            print(
-                f'[ACCOUNT CREATED FOR] for {self.get_name()}')
+    def create_account(self, user_account_details: dict) -> bool:
+        """Creates the account and tells the client if it was created returning the same"""
+        account_created = False
+        try:
+            account_created = self.store_user_login_details(
+                user_account_details['user_id'], user_account_details['screen_name'], user_account_details['password'])
+        except Exception as e:
+            print(e)
+        finally:
+            self.send_encrypted_data_to_client(
+                {'recipient': 'CLIENT', 'account created': account_created})
+            self.client_user_id = user_account_details['user_id']
+        if account_created:
+            online_users.login(self.client_user_id, self)
+        print(
+            f'[ACCOUNT CREATED FOR] for {self.get_name()}')
         return account_created
 
     def is_user_already_online(self, user_id):
-        for user in active_clients:
-            if user.client_user_id == user_id:
-                return True
-        return False
+        return online_users.is_online(user_id)
 
     def store_user_login_details(self, user_id, screen_name, password):
         """Adds users id, screen name, hashed password, password salt and public key to the servers database"""
         salt = bcrypt.gensalt()  # salt generated outside function as it needs to be stored
         peppered_hash = self.hash_password(password, salt)
-        seralized_public_key = self.serialize_object(
+        seralized_public_key = public_keys.encode_public_key(
             self.client_public_key)  # sql cant store python objects
 
         return sql.add_user(user_id, screen_name, peppered_hash,
@@ -207,123 +374,435 @@ class UserHandler(BaseClass):
         print(f"[HANDELING LOGGED IN USER {self.get_name()}]")
         # second swap required to get the 'real' keys rather than the temp keys
         self.swap_public_keys()
+        self.store_client_codec()
+        self.send_screen_name()
+        self.recieve_data_from_logged_in_user()
 
+    def store_client_codec(self):
+        """Records whether this user's client reads the binary codec (and compressed and conversation key lumps) so senders can use it"""
+        sql.set_user_codec(self.client_user_id,
+                           CODEC_JSON if self.legacy_framing else CODEC_BINARY)
+
+    def public_key_for_client(self, encoded_public_key: str) -> str:
+        """Returns a stored public key in the form the client reads - pickled for legacy clients, otherwise base64 DER"""
+        if self.legacy_framing or self.codec == CODEC_JSON:
+            return self.serialize_object(public_keys.decode_public_key(encoded_public_key))
+        return encoded_public_key
+
+    def send_screen_name(self):
         screen_name = sql.get_screen_name(self.client_user_id)
         self.send_data_to_client(
             {'recipient': 'CLIENT', 'screen_name': screen_name})
 
-        self.recieve_data_from_logged_in_user()
-
     def recieve_data_from_logged_in_user(self):
         """Recieved encrypted data from logged in user and handels it accordingly"""
 
-        # recieved_data = (for_server: bool, seralized_lump_data: dict, seralized_signature: dict)
+        # recieved_data = (True, data) or (False, seralized_lump_data, seralized_signature, flags, recipient_user_id)
         connected = True
         while connected:
             recieved_data = self.recieve_encrypted_data(server_private_key)
             if recieved_data[0]:  # data is for the server
-                print(f"[RECIEVED DATA FROM {self.get_name()} FOR SERVER]")
-                data = recieved_data[1]
-                print(f"{data = }\n\n")
-
-                if data['type'] == 'check_if_friend_code_exists':
-                    self.send_encrypted_data_to_client(
-                        {'exist': sql.check_user_id_exists(data['friend_code'])})
-
-                if data['type'] == 'get_recipient_public_key':
-                    seralized_public_key = sql.get_public_key(
-                        data['recipient_user_id'])
-                    self.send_encrypted_data_to_client(
-                        {'recipient_public_key': seralized_public_key})
-
-                if data['type'] == 'get_friend_detials':
-                    self.send_encrypted_data_to_client(
-                        {
-                            'screen_name': sql.get_screen_name(data['friend_user_id']),
-                            'public_key': sql.get_public_key(data['friend_user_id'])
-                        })
-                if data['type'] == 'request_all_user_data':
-                    user_details = sql.get_user_details(self.client_user_id)
-                    self.send_encrypted_data_to_client(
-                        {
-                            'user_details': user_details
-                        }
-                    )
-                if data['type'] == 'deleting_account':
-                    account_deleted, account_deletion_name = sql.delete_account_server(
-                        self.client_user_id)
-                    self.send_encrypted_data_to_client(
-                        {
-                            'account_deleted': account_deleted,
-                            'account_deletion_name': account_deletion_name
-                        }
-                    )
-
-                if data['type'] == 'change_screen_name':
-                    new_screen_name = data['new_screen_name']
-                    print('UPDATING SCREEN NAME')
-                    sql.update_screen_name_server(
-                        self.client_user_id, new_screen_name)
-
-                if data['type'] == 'can_recieve_msg_value':
-                    self.can_recieve_msg = data['can_recieve_msg']
-                    if self.can_recieve_msg:
-                        self.recieved_message_queue()
-
+                self.handle_request(recieved_data[1])
             else:  # lump data is for the client!
                 print(f"[RECIEVED DATA FROM {self.get_name()} TO FORWARD]")
                 self.forward_data_to_client(recieved_data)
 
+    def handle_request(self, data: dict):
+        """Handels data sent to the server by a logged in user"""
+        print(f"[RECIEVED DATA FROM {self.get_name()} FOR SERVER]")
+        print(f"{data = }\n\n")
+
+        if data['type'] == 'check_if_friend_code_exists':
+            self.send_encrypted_data_to_client(
+                {'exist': sql.check_user_id_exists(data['friend_code'])})
+
+        if data['type'] == 'get_recipient_public_key':
+            seralized_public_key = self.public_key_for_client(sql.get_public_key(
+                data['recipient_user_id']))
+            self.send_encrypted_data_to_client(
+                {'recipient_public_key': seralized_public_key,
+                 'recipient_codec': sql.get_user_codec(data['recipient_user_id']) or CODEC_JSON})
+
+        if data['type'] == 'get_friend_detials':
+            self.send_encrypted_data_to_client(
+                {
+                    'screen_name': sql.get_screen_name(data['friend_user_id']),
+                    'public_key': self.public_key_for_client(sql.get_public_key(data['friend_user_id']))
+                })
+        if data['type'] == 'request_all_user_data':
+            user_id, screen_name, public_key = sql.get_user_details(
+                self.client_user_id)
+            user_details = (user_id, screen_name,
+                            self.public_key_for_client(public_key))
+            self.send_encrypted_data_to_client(
+                {
+                    'user_details': user_details
+                }
+            )
+        if data['type'] == 'deleting_account':
+            account_deleted, account_deletion_name = sql.delete_account_server(
+                self.client_user_id)
+            self.send_encrypted_data_to_client(
+                {
+                    'account_deleted': account_deleted,
+                    'account_deletion_name': account_deletion_name
+                }
+            )
+
+        if data['type'] == 'change_screen_name':
+            new_screen_name = data['new_screen_name']
+            print('UPDATING SCREEN NAME')
+            sql.update_screen_name_server(
+                self.client_user_id, new_screen_name)
+
+        if data['type'] == 'can_recieve_msg_value':
+            self.set_can_recieve_msg(data['can_recieve_msg'])
+            if self.can_recieve_msg:
+                self.recieved_message_queue()
+
+    def set_can_recieve_msg(self, can_recieve_msg: bool):
+        self.can_recieve_msg = can_recieve_msg
+        online_users.set_can_recieve_msg(
+            self.client_user_id, self, can_recieve_msg)
+
     def forward_data_to_client(self, recieved_data):
-        """Attempts to forward data to intended recipient. If it can't adds to the message queue instead"""
-        recipient_found = False
-        seralized_lump_data = recieved_data[1]
-        seralized_signature = recieved_data[2]
-        recipient_user_id = self.deserialize_dict(seralized_lump_data)[
-            'recipient_user_id']
-
-        for client in active_clients:
-            if client.client_user_id == recipient_user_id and client.can_recieve_msg == True:
-                from_message_queue = self.get_name() == client.get_name()
-                print(
-                    f"[FORWARDING DATA FROM {self.get_name()} TO {client.get_name()}] FROM MESSAGE QUEUE {from_message_queue}")
-                client.forward_data(seralized_lump_data, seralized_signature)
-                recipient_found = True
-                break
+        """
+        Attempts to forward data to intended recipient. If it can't adds to the message queue instead
 
-        if not recipient_found:
-            # adding recipient_user_id as it means deserialization is not needed for each item when searching queue
-            message_queue.enQueue(recipient_user_id, recieved_data)
+        Returns the recipient's handler if it was forwarded, otherwise None
+        """
+        seralized_lump_data, seralized_signature, flags, recipient_user_id = recieved_data[1:]
+
+        client = online_users.get_reciever(recipient_user_id)
+        if client is not None:
+            from_message_queue = self.get_name() == client.get_name()
+            print(
+                f"[FORWARDING DATA FROM {self.get_name()} TO {client.get_name()}] FROM MESSAGE QUEUE {from_message_queue}")
+            client.forward_data(
+                seralized_lump_data, seralized_signature, flags)
+            return client
+        self.queue_data_for_client(recieved_data)
+        return None
+
+    def queue_data_for_client(self, recieved_data):
+        """Adds data for another client to the message queue"""
+        seralized_lump_data, seralized_signature, flags, recipient_user_id = recieved_data[1:]
+        # adding recipient_user_id as it means deserialization is not needed for each item when searching queue
+        # copied out of the receive buffer as the next frame overwrites it
+        message_queue.enQueue(recipient_user_id, (False, bytes(seralized_lump_data), bytes(
+            seralized_signature), flags, recipient_user_id))
 
     def recieved_message_queue(self):
-        """Sends messages waiting in message_queue to relevant client"""
-        for message in message_queue.get().copy():
-            if message[0] == self.client_user_id:
-                message_queue.deQeueu(self.client_user_id, message[1])
-                self.forward_data_to_client(message[1])
+        """Sends messages waiting in message_queue to relevant client in batches"""
+        # stops if they can no longer recieve messages as forward_data_to_client would queue them again
+        while online_users.get_reciever(self.client_user_id) is self:
+            messages = message_queue.take(
+                self.client_user_id, DELIVERY_BATCH_SIZE)
+            if not messages:
+                break
+            for message in messages:
+                self.forward_data_to_client(message)
+
+
+class AsyncUserHandler(UserHandler):
+    """
+    UserHandler run as a coroutine on the servers event loop
+
+    Only receiving is done on the loop - signature checks, decryption, password
+    hashing and database lookups are done with run_crypto so idle connections
+    don't need a thread each
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        super().__init__('SERVER', writer.get_extra_info('socket'),
+                         writer.get_extra_info('peername'))
+        self.attach_streams(reader, writer)
+        # so draining only waits once this connection is well behind
+        writer.transport.set_write_buffer_limits(high=FORWARD_HIGH_WATER)
+        self.queue_delivery = None  # task sending messages queued while this connection was behind
+
+    def is_backed_up(self) -> bool:
+        """Returns True if too much is waiting to be sent to this client to forward it any more"""
+        return self.writer.transport.get_write_buffer_size() >= FORWARD_HIGH_WATER
+
+    async def drain_for_sender(self):
+        """Waits (up to FORWARD_DRAIN_TIMEOUT) for what was forwarded to this client to be written"""
+        try:
+            await asyncio.wait_for(self.drain(), FORWARD_DRAIN_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            # the sender carries on - later messages are queued while this client is backed up
+            pass
+
+    def schedule_queue_delivery(self):
+        """Starts sending this client's queued messages once it has caught up (if not already)"""
+        if self.queue_delivery is None:
+            self.queue_delivery = asyncio.ensure_future(
+                self.deliver_queued_messages())
+
+    async def deliver_queued_messages(self):
+        try:
+            # checked on the loop after each batch so a message queued meanwhile is not left behind
+            while message_queue.count(self.client_user_id):
+                await self.drain()
+                # stops if they can no longer recieve messages as forward_data_to_client would queue them again
+                if online_users.get_reciever(self.client_user_id) is not self:
+                    break
+                messages = await self.run_crypto(message_queue.take, self.client_user_id, DELIVERY_BATCH_SIZE)
+                for message in messages:
+                    self.forward_data_to_client(message)
+        except ConnectionError:
+            pass
+        finally:
+            self.queue_delivery = None
+
+    def close_connection(self):
+        self.writer.close()
+
+    async def async_recieve_encrypted_data_from_client(self):
+        return (await self.async_recieve_encrypted_data(server_private_key))[1]
+
+    async def handel(self):
+        print(f"[HANDELING LOGGED OUT CLIENT {self.get_name()}]")
+        await self.async_swap_public_keys()
+        await self.async_handle_logged_out_client()
+
+    async def async_swap_public_keys(self):
+        print(
+            f"[PUBLIC KEY SWAP] Swapping public keys with {self.get_name()}")
+        await self.run_crypto(self.reply_to_public_key_swap, await self.async_receive_data())
+
+    async def async_handle_logged_out_client(self):
+        login = False
+
+        while login != True:
+            determiner = await self.async_receive_data()
+            if determiner['type'] == 'login request':
+                login_details = await self.async_recieve_encrypted_data_from_client()
+                login = await self.run_crypto(self.reply_to_login, login_details)
+            elif determiner['type'] == 'create account request':
+                details = await self.async_recieve_encrypted_data_from_client()
+                if not await self.run_crypto(self.reply_to_user_id_check, details):
+                    user_account_details = await self.async_recieve_encrypted_data_from_client()
+                    login = await self.run_crypto(self.create_account, user_account_details)
+        await self.async_handle_logged_in_client()
+
+    async def async_handle_logged_in_client(self):
+        print(f"[HANDELING LOGGED IN USER {self.get_name()}]")
+        # second swap required to get the 'real' keys rather than the temp keys
+        await self.async_swap_public_keys()
+        await self.run_crypto(self.store_client_codec)
+        await self.run_crypto(self.send_screen_name)
+
+        while True:
+            recieved_data = await self.async_recieve_encrypted_data(server_private_key)
+            if recieved_data[0]:  # data is for the server
+                await self.run_crypto(self.handle_request, recieved_data[1])
+            else:
+                await self.async_forward_data_to_client(recieved_data)
+
+    async def async_forward_data_to_client(self, recieved_data):
+        """
+        Forwards lump data on the loop then waits for the recipient to catch up
+
+        Queued instead if the recipient is offline, backed up or still has
+        queued messages (so the queue is delivered in order)
+        """
+        recipient_user_id = recieved_data[4]
+        recipient = online_users.get_reciever(recipient_user_id)
+        if recipient is None or recipient.is_backed_up() or message_queue.count(recipient_user_id):
+            # queued in the database so done off the loop
+            print(f"[RECIEVED DATA FROM {self.get_name()} TO QUEUE]")
+            await self.run_crypto(self.queue_data_for_client, recieved_data)
+            if recipient is not None:
+                recipient.schedule_queue_delivery()
+            return
+        # lump data is for the client - forwarded on the loop as it needs no crypto
+        print(f"[RECIEVED DATA FROM {self.get_name()} TO FORWARD]")
+        self.forward_data_to_client(recieved_data)
+        # the recipients buffer is only emptied as fast as they read so this sender waits for them
+        await recipient.drain_for_sender()
 
 
 class MessageQueue():
-    def __init__(self):
-        self.__items = []
+    """
+    Messages waiting for offline users, stored in the database so they survive restarts
+
+    Every message is appended to the offline_messages table when it is queued.
+    The newest few for each user are kept in memory as well (up to
+    hot_tail_size each and memory_budget bytes in total) so a user who is only
+    briefly offline is sent them without reading the database. Past the
+    budget the least recently queued to users' messages are dropped from
+    memory and read back from the database in batches when they reconnect.
+    Messages older than ttl seconds are deleted without being delivered.
+
+    All access is under one lock as messages are queued from connection
+    threads (or the event loop) while others are being delivered
+    """
+
+    def __init__(self, store: serverDatabase.Database, memory_budget: int = QUEUE_MEMORY_BUDGET,
+                 hot_tail_size: int = HOT_TAIL_SIZE, ttl: float = MESSAGE_TTL):
+        self.__lock = threading.Lock()
+        self.__store = store
+        self.memory_budget = memory_budget
+        self.hot_tail_size = hot_tail_size
+        self.ttl = ttl
+        # recipient -> deque of (message_id, queued, message, size) for their newest messages,
+        # least recently queued to first so they are dropped from memory first
+        self.__mailboxes = OrderedDict()
+        self.__on_disk = {}  # recipient -> number of older messages only in the database
+        self.__size = 0
+        self.__memory = 0
+        self.__last_eviction = 0
+
+        self.__store.offline_message_tables()
+        with self.__lock:
+            self.__evict_expired()
+        print(f"[MESSAGE QUEUE] {self.__size} messages waiting")
 
     def isEmpty(self):
-        return len(self.__items) == 0
+        return len(self) == 0
 
     def enQueue(self, client_recieving_user_id: str, message: list):
-        values = (client_recieving_user_id, message)
-        self.__items.append(values)
-
-    def deQeueu(self, client_recieving_user_id: str, message: list):
-        if not self.isEmpty():
-            values = (client_recieving_user_id, message)
-            try:
-                self.__items.remove(values)
-            except Exception as e:
-                print(f"[deQueue ERROR] {e}")
-
-    def get(self):
-        return self.__items
+        seralized_lump_data, seralized_signature, flags = message[1:4]
+        size = len(seralized_lump_data) + len(seralized_signature)
+        with self.__lock:
+            queued = time.time()
+            message_id = self.__store.store_offline_message(
+                client_recieving_user_id, seralized_lump_data, seralized_signature, flags or 0, queued)
+
+            mailbox = self.__mailboxes.get(client_recieving_user_id)
+            if mailbox is None:
+                mailbox = self.__mailboxes[client_recieving_user_id] = deque()
+            else:
+                self.__mailboxes.move_to_end(client_recieving_user_id)
+            mailbox.append((message_id, queued, message, size))
+            self.__size += 1
+            self.__memory += size
+
+            if len(mailbox) > self.hot_tail_size:
+                self.__spill(client_recieving_user_id, 1)
+            while self.__memory > self.memory_budget and self.__mailboxes:
+                user_id = next(iter(self.__mailboxes))
+                self.__spill(user_id, len(self.__mailboxes[user_id]))
+            self.__evict_if_due()
+
+    def take(self, client_recieving_user_id: str, limit: int = DELIVERY_BATCH_SIZE) -> list:
+        """Removes and returns up to limit of the oldest messages for the recipient"""
+        with self.__lock:
+            self.__evict_if_due()
+            messages = []
+            last_message_id = None
+            mailbox = self.__mailboxes.get(client_recieving_user_id, deque())
+
+            on_disk = self.__on_disk.get(client_recieving_user_id, 0)
+            if on_disk:
+                rows = self.__store.get_offline_messages(
+                    client_recieving_user_id, limit)
+                for message_id, seralized_lump_data, seralized_signature, flags, queued in rows:
+                    messages.append((False, seralized_lump_data, seralized_signature,
+                                     flags, client_recieving_user_id))
+                    last_message_id = message_id
+                # the oldest rows are normally the ones not in memory but skip any that are
+                in_memory = 0
+                while mailbox and mailbox[0][0] is not None and last_message_id is not None and mailbox[0][0] <= last_message_id:
+                    self.__memory -= mailbox.popleft()[3]
+                    in_memory += 1
+                on_disk = max(0, on_disk - (len(rows) - in_memory))
+                if on_disk:
+                    self.__on_disk[client_recieving_user_id] = on_disk
+                else:
+                    self.__on_disk.pop(client_recieving_user_id, None)
+
+            while mailbox and len(messages) < limit:
+                message_id, queued, message, size = mailbox.popleft()
+                messages.append(message)
+                self.__memory -= size
+                if message_id is not None:
+                    last_message_id = message_id
+            if not mailbox:
+                self.__mailboxes.pop(client_recieving_user_id, None)
+
+            if last_message_id is not None:
+                self.__store.delete_offline_messages(
+                    client_recieving_user_id, last_message_id)
+            self.__size -= len(messages)
+            return messages
+
+    def drain(self, client_recieving_user_id: str) -> list:
+        """Removes and returns every message for the recipient, oldest first"""
+        messages = []
+        batch = self.take(client_recieving_user_id)
+        while batch:
+            messages.extend(batch)
+            batch = self.take(client_recieving_user_id)
+        return messages
+
+    def count(self, client_recieving_user_id: str) -> int:
+        with self.__lock:
+            return self.__on_disk.get(client_recieving_user_id, 0) + len(self.__mailboxes.get(client_recieving_user_id, ()))
+
+    def counts(self) -> dict:
+        """Returns the number of messages waiting for each recipient"""
+        with self.__lock:
+            counts = dict(self.__on_disk)
+            for user_id, mailbox in self.__mailboxes.items():
+                counts[user_id] = counts.get(user_id, 0) + len(mailbox)
+            return counts
+
+    def memory_used(self) -> int:
+        """Returns the number of bytes of messages kept in memory"""
+        with self.__lock:
+            return self.__memory
+
+    def evict_expired(self):
+        """Deletes every message older than ttl"""
+        with self.__lock:
+            self.__evict_expired()
+
+    def __spill(self, client_recieving_user_id: str, number: int):
+        """Drops the oldest number of the recipients messages from memory leaving them in the database"""
+        mailbox = self.__mailboxes[client_recieving_user_id]
+        for _ in range(number):
+            message_id, queued, message, size = mailbox.popleft()
+            self.__memory -= size
+            if message_id is None:  # storing it failed so it can't be read back
+                print(
+                    f"[MESSAGE DROPPED] for {client_recieving_user_id} as it could not be stored")
+                self.__size -= 1
+            else:
+                self.__on_disk[client_recieving_user_id] = self.__on_disk.get(
+                    client_recieving_user_id, 0) + 1
+        if not mailbox:
+            del self.__mailboxes[client_recieving_user_id]
+
+    def __evict_if_due(self):
+        if time.time() - self.__last_eviction >= EVICTION_INTERVAL:
+            self.__evict_expired()
+
+    def __evict_expired(self):
+        now = time.time()
+        expired_before = now - self.ttl
+        self.__store.delete_expired_offline_messages(expired_before)
+        for user_id, mailbox in list(self.__mailboxes.items()):
+            while mailbox and mailbox[0][1] < expired_before:
+                self.__memory -= mailbox.popleft()[3]
+            if not mailbox:
+                del self.__mailboxes[user_id]
+
+        # recount what is only in the database from what is left in it
+        self.__on_disk = {}
+        for user_id, number in self.__store.get_offline_message_counts():
+            mailbox = self.__mailboxes.get(user_id, ())
+            on_disk = number - sum(1 for entry in mailbox if entry[0] is not None)
+            if on_disk > 0:
+                self.__on_disk[user_id] = on_disk
+        self.__size = sum(self.__on_disk.values()) + \
+            sum(len(mailbox) for mailbox in self.__mailboxes.values())
+        self.__last_eviction = now
+
+    def __len__(self):
+        with self.__lock:
+            return self.__size
 
 
 def worker(client, addr):
@@ -332,12 +811,49 @@ def worker(client, addr):
     try:
         new_user.handel()
     except ClientDisconnectException:
+        pass
+    except (SessionAuthenticationError, ValueError) as e:  # tampered, replayed or malformed frame
+        print(f"[DROPPING CLIENT {new_user.get_name()}] {e!r}")
+    finally:
+        # always done so a connection that fails for any reason can't leave its user logged in
+        new_user.handel_disconnect()
+
+
+async def async_worker(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    new_user = AsyncUserHandler(reader, writer)
+    try:
+        await new_user.handel()
+    except ClientDisconnectException:
+        pass
+    except (SessionAuthenticationError, ValueError) as e:
+        print(f"[DROPPING CLIENT {new_user.get_name()}] {e!r}")
+    finally:
         new_user.handel_disconnect()
 
 
 # ------DRIVER CODE------
 
+def setup_server():
+    """Makes the server's keys, opens and migrates the database and loads the message queue"""
+    global server_public_key, server_private_key, sql, message_queue
+    server_public_key, server_private_key = rsa.newkeys(512)
+    sql = serverDatabase.Database(database)
+    sql.server_tables()
+    sql.migrate_public_keys('users')
+    # own connection as messages are queued and delivered from many threads at once
+    message_queue = MessageQueue(serverDatabase.Database(database))
+    start_crypto_pool()
+
+
+def start_crypto_pool():
+    global crypto_pool
+    if CRYPTO_PROCESSES > 0:
+        crypto_pool = CryptoPool(server_private_key, CRYPTO_PROCESSES)
+        print(f"[CRYPTO POOL] {CRYPTO_PROCESSES} processes")
+
+
 def main():
+    setup_server()
     # create new socket object
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
@@ -353,5 +869,17 @@ def main():
         thread.start()
 
 
-message_queue = MessageQueue()
-main()
+async def async_main():
+    """Runs every connection on one event loop instead of a thread each"""
+    setup_server()
+    server = await asyncio.start_server(async_worker, SERVER, PORT)
+    print(f"[LISTENING] Asyncio server is listening on {SERVER} {PORT}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':  # crypto pool workers import this module when they are spawned
+    if SERVER_MODE == 'asyncio':
+        asyncio.run(async_main())
+    else:
+        main()
@@ -0,0 +1,117 @@
+"""
+Compact encoding for RSA public keys.
+
+Keys are stored and sent as base64 text of their PKCS#1 DER encoding
+rather than a pickled rsa.PublicKey. The text has no spaces so it can
+still be split out of the GUI's friend details.
+
+Parsed keys are cached by their encoding, so looking up the same sender's
+key for every signature does not parse it again.
+"""
+import base64
+import io
+import pickle
+import threading
+from collections import OrderedDict
+
+import rsa
+
+
+FORMAT = 'utf-8'
+KEY_CACHE_SIZE = 1024  # most keys kept parsed at once
+PICKLE_PROTOCOL_PREFIX = b'\x80'  # every pickle from protocol 2 onwards starts with this
+
+
+class LegacyKeyUnpickler(pickle.Unpickler):
+    """Only unpickles rsa.PublicKey objects so stored keys can't run arbitrary code"""
+
+    def find_class(self, module, name):
+        if (module, name) == ('rsa.key', 'PublicKey'):
+            return rsa.PublicKey
+        raise pickle.UnpicklingError(
+            f"{module}.{name} is not allowed in a pickled public key")
+
+
+class PublicKeyCache():
+    """Parsed rsa.PublicKey objects keyed by their DER bytes, dropping the least recently used"""
+
+    def __init__(self, max_size: int = KEY_CACHE_SIZE):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, der: bytes) -> rsa.PublicKey:
+        """Returns the key encoded by der parsing it if it is not already cached"""
+        with self.lock:
+            public_key = self.keys.get(der)
+            if public_key is not None:
+                self.keys.move_to_end(der)
+                self.hits += 1
+                return public_key
+            self.misses += 1
+
+        public_key = rsa.PublicKey.load_pkcs1(der, 'DER')
+        with self.lock:
+            self.keys[der] = public_key
+            if len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+        return public_key
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.keys), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+
+PUBLIC_KEY_CACHE = PublicKeyCache()
+
+
+def public_key_to_der(public_key: rsa.PublicKey) -> bytes:
+    """Returns the PKCS#1 DER encoding of public_key"""
+    return public_key.save_pkcs1('DER')
+
+
+def public_key_from_der(der) -> rsa.PublicKey:
+    """Returns the (cached) key for DER bytes"""
+    return PUBLIC_KEY_CACHE.get(bytes(der))
+
+
+def encode_public_key(public_key: rsa.PublicKey) -> str:
+    """Returns public_key as base64 DER text for storing in the database"""
+    return base64.b64encode(public_key_to_der(public_key)).decode(FORMAT)
+
+
+def is_legacy_public_key(encoded: str) -> bool:
+    """Returns True if encoded is a base64 pickled key rather than base64 DER"""
+    return base64.b64decode(encoded).startswith(PICKLE_PROTOCOL_PREFIX)
+
+
+def load_legacy_public_key(encoded: str) -> rsa.PublicKey:
+    """Returns the key from a base64 pickled rsa.PublicKey (the old storage format)"""
+    pickled_key = base64.b64decode(encoded)
+    return LegacyKeyUnpickler(io.BytesIO(pickled_key)).load()
+
+
+def decode_public_key(encoded: str) -> rsa.PublicKey:
+    """Returns the key from base64 DER text (or the old pickled format if a row has not been migrated)"""
+    der = base64.b64decode(encoded)
+    if der.startswith(PICKLE_PROTOCOL_PREFIX):
+        return load_legacy_public_key(encoded)
+    return PUBLIC_KEY_CACHE.get(der)
+
+
+def migrate_public_key(encoded: str) -> str:
+    """Returns encoded converted to base64 DER (unchanged if it already is)"""
+    if is_legacy_public_key(encoded):
+        return encode_public_key(load_legacy_public_key(encoded))
+    return encoded
@@ -2,6 +2,7 @@ import sqlite3
 from sqlite3 import Error
 # from pathlib import Path
 from random import randint
+import public_keys
 
 """
 status:
@@ -62,6 +63,38 @@ class Database():
         finally:
             c.close()
 
+    def migrate_public_keys(self, table: str) -> int:
+        """
+        Rewrites pickled public keys in table (users or friendships) as base64 DER
+
+        Returns the number of rows changed
+        """
+        id_column = {'users': 'user_id', 'friendships': 'friend_id'}[table]
+        c = self.conn.cursor()
+        migrated = 0
+        try:
+            c.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            if c.fetchall()[0][0] == 0:  # tables are made after connecting for new users
+                return 0
+            c.execute(f"SELECT {id_column}, public_key FROM {table}")
+            for row_id, public_key in c.fetchall():
+                new_public_key = public_keys.migrate_public_key(public_key)
+                if new_public_key != public_key:
+                    c.execute(f"UPDATE {table} SET public_key = ? WHERE {id_column} = ?",
+                              (new_public_key, row_id))
+                    migrated += 1
+            self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"MIGRATION SQL ERROR: {e}")
+            self.conn.rollback()
+            migrated = 0
+        finally:
+            c.close()
+        if migrated:
+            print(f"[DB] Migrated {migrated} public keys in {table} to DER")
+        return migrated
+
     # ----------SERVER DATABASE FUNCTIONS----------
 
     def server_tables(self):
@@ -74,8 +107,15 @@ class Database():
         public_key text NOT NULL,
         UNIQUE(user_id)
         );"""
+        # the codec each users client reads relayed data in, so senders know if they can use binary
+        sql_create_user_codecs_table = """
+        CREATE TABLE IF NOT EXISTS user_codecs(
+        user_id text NOT NULL PRIMARY KEY,
+        codec text NOT NULL
+        );"""
         if self.conn is not None:
             self.create_table(sql_create_user_table)
+            self.create_table(sql_create_user_codecs_table)
 
     def add_user(self, user_id: str, screen_name: str, hashed_password: str, salt: bytes, public_key: str) -> bool:
         """Adds a new user to the database"""
@@ -120,6 +160,18 @@ class Database():
             "SELECT hashed_password, salt FROM users WHERE user_id=?", (user_id,))
         return c.fetchall()
 
+    def set_user_codec(self, user_id: str, codec: str):
+        values = (user_id, codec)
+        sql = """INSERT OR REPLACE INTO user_codecs(user_id, codec) VALUES(?,?)"""
+        self.execute_insert(sql, values)
+
+    def get_user_codec(self, user_id: str):
+        """Gets the codec user_id's client reads or None if they have not logged in since it was recorded"""
+        c = self.conn.cursor()
+        c.execute("SELECT codec FROM user_codecs WHERE user_id=?", (user_id, ))
+        row = c.fetchone()
+        return row[0] if row else None
+
     def check_user_id_exists(self, user_id: str) -> bool:
         """Returns True if user exists. False if they do not"""
         c = self.conn.cursor()
@@ -158,6 +210,83 @@ class Database():
             c.close()
             return success, new_user_id
 
+    def offline_message_tables(self):
+        # message_id only ever increases so it gives the order messages were queued in
+        sql_create_offline_messages_table = """
+        CREATE TABLE IF NOT EXISTS offline_messages(
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        recipient_user_id text NOT NULL,
+        lump blob NOT NULL,
+        signature blob NOT NULL,
+        flags integer NOT NULL,
+        queued real NOT NULL
+        );"""
+        sql_create_recipient_index = """
+        CREATE INDEX IF NOT EXISTS offline_messages_recipient
+        ON offline_messages(recipient_user_id, message_id);"""
+        sql_create_queued_index = """
+        CREATE INDEX IF NOT EXISTS offline_messages_queued
+        ON offline_messages(queued);"""
+        if self.conn is not None:
+            self.create_table(sql_create_offline_messages_table)
+            self.create_table(sql_create_recipient_index)
+            self.create_table(sql_create_queued_index)
+
+    def store_offline_message(self, recipient_user_id: str, lump: bytes, signature: bytes, flags: int, queued: float):
+        """Appends a message for an offline user returning its message_id (None if it could not be stored)"""
+        values = (recipient_user_id, lump, signature, flags, queued)
+        sql = """INSERT INTO offline_messages(recipient_user_id, lump, signature, flags, queued) VALUES(?,?,?,?,?)"""
+        c = self.conn.cursor()
+        try:
+            c.execute(sql, values)
+            self.conn.commit()
+            return c.lastrowid
+        except sqlite3.Error as e:
+            print(f"INSERT SQL ERROR: {e}\nfor {sql = }")
+            self.conn.rollback()
+            return None
+        finally:
+            c.close()
+
+    def get_offline_messages(self, recipient_user_id: str, limit: int):
+        """Gets the oldest limit messages for recipient_user_id"""
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT message_id, lump, signature, flags, queued
+            FROM offline_messages
+            WHERE recipient_user_id = ?
+            ORDER BY message_id ASC
+            LIMIT ?;
+            """, (recipient_user_id, limit))
+        return c.fetchall()
+
+    def delete_offline_messages(self, recipient_user_id: str, last_message_id: int):
+        """Deletes every message for recipient_user_id up to and including last_message_id"""
+        values = (recipient_user_id, last_message_id)
+        sql = """
+        DELETE FROM offline_messages
+        WHERE recipient_user_id = ? AND message_id <= ?;
+        """
+        self.execute_update(sql, values)
+
+    def delete_expired_offline_messages(self, queued_before: float):
+        values = (queued_before, )
+        sql = """
+        DELETE FROM offline_messages
+        WHERE queued < ?;
+        """
+        self.execute_update(sql, values)
+
+    def get_offline_message_counts(self):
+        """Gets (recipient_user_id, number of messages) for every user with messages waiting"""
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT recipient_user_id, COUNT(*)
+            FROM offline_messages
+            GROUP BY recipient_user_id;
+            """)
+        return c.fetchall()
+
     # ----------CLIENT DATABASE FUNCTIONS----------
 
     def client_tables(self):
@@ -184,9 +313,30 @@ class Database():
         PRIMARY KEY (friend_id)
         );"""
 
+        sql_create_conversation_keys_table = """
+        CREATE TABLE IF NOT EXISTS conversation_keys (
+        friend_id text NOT NULL,
+        direction text NOT NULL,
+        key_id text NOT NULL,
+        encrypted_key blob NOT NULL,
+        created real NOT NULL,
+        sequence integer NOT NULL,
+        PRIMARY KEY (friend_id, direction)
+        );"""
+
+        # every recv key_id ever accepted so a replayed key envelope can't reset its sequence
+        sql_create_received_conversation_keys_table = """
+        CREATE TABLE IF NOT EXISTS received_conversation_keys (
+        friend_id text NOT NULL,
+        key_id text NOT NULL,
+        PRIMARY KEY (friend_id, key_id)
+        );"""
+
         if self.conn is not None:
             self.create_table(sql_create_messages_table)
             self.create_table(sql_create_friendships_table)
+            self.create_table(sql_create_conversation_keys_table)
+            self.create_table(sql_create_received_conversation_keys_table)
 
     def new_blocked_friend(self, user_id: str, friend_user_id: str):
         """Sets status to blk where user_id has blocked friend_user_id"""
@@ -235,6 +385,17 @@ class Database():
             """, (user_id,))
         return c.fetchall()
 
+    def get_friend_public_key(self, friend_id: str):
+        """Gets the stored public key of friend_id or None if they are not a friend"""
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT public_key
+            FROM friendships
+            WHERE friend_id = ? and status = 'acc';
+            """, (friend_id,))
+        row = c.fetchone()
+        return row[0] if row else None
+
     def get_pending_friends_list(self, user_id: str):
         print(f"GETTING PENDING FRIEND LIST")
         c = self.conn.cursor()
@@ -292,6 +453,45 @@ class Database():
         sql = """INSERT INTO messages(friend_id, encrypted_Epk, message_text, date, time, from_me, is_image) VALUES(?,?,?,?,?,?,?)"""
         self.execute_insert(sql, values)
 
+    def store_conversation_key(self, friend_id: str, direction: str, key_id: str, encrypted_key: bytes, created: float, sequence: int):
+        """Stores the current send or recv conversation key for friend_id replacing the last one"""
+        values = (friend_id, direction, key_id,
+                  encrypted_key, created, sequence)
+        sql = """INSERT OR REPLACE INTO conversation_keys(friend_id, direction, key_id, encrypted_key, created, sequence) VALUES(?,?,?,?,?,?)"""
+        self.execute_insert(sql, values)
+
+    def add_received_conversation_key_id(self, friend_id: str, key_id: str):
+        values = (friend_id, key_id)
+        sql = """INSERT OR IGNORE INTO received_conversation_keys(friend_id, key_id) VALUES(?,?)"""
+        self.execute_insert(sql, values)
+
+    def check_received_conversation_key_id(self, friend_id: str, key_id: str) -> bool:
+        """Returns True if key_id has been received from friend_id before (including the current recv key)"""
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT 1 FROM received_conversation_keys WHERE friend_id = ? AND key_id = ?
+            UNION
+            SELECT 1 FROM conversation_keys WHERE friend_id = ? AND direction = 'recv' AND key_id = ?;
+            """, (friend_id, key_id, friend_id, key_id))
+        return c.fetchone() is not None
+
+    def update_conversation_key_sequence(self, friend_id: str, direction: str, key_id: str, sequence: int):
+        values = (sequence, friend_id, direction, key_id)
+        sql = """
+        UPDATE conversation_keys
+        SET sequence = ?
+        WHERE friend_id = ? AND direction = ? AND key_id = ?;
+        """
+        self.execute_update(sql, values)
+
+    def get_conversation_keys(self):
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT friend_id, direction, key_id, encrypted_key, created, sequence
+            FROM conversation_keys;
+            """)
+        return c.fetchall()
+
     def update_friend_screen_name(self, friend_id: str, friend_screen_name: str):
         values = (friend_screen_name, friend_id)
         sql = """